@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of message serialization: the old as_string() send path
+against BytesGenerator output with the encoded-image cache.
+
+    python bench_mime.py [--sizes 100000,1000000,5000000] [--iterations 20]
+"""
+import argparse
+import json
+import os
+import smtplib
+import time
+import tracemalloc
+from email.mime.image import MIMEImage
+from email.mime.text import MIMEText
+
+import smtp_river_no_duplicate as river
+
+CONFIG = {'your_email': 'bench@example.com'}
+
+
+def old_path(image, html):
+    # What send_email_with_image used to do: encode the image for every
+    # message, as_string(), then smtplib's str -> CRLF str -> bytes conversion
+    img = MIMEImage(image, 'png')
+    img.add_header('Content-ID', '<image1>')
+    img.add_header('Content-Disposition', 'inline', filename='photo.png')
+    msg = river.build_message(CONFIG, 'to@example.com', 'Bench', 'Bench', MIMEText(html, 'html'), img)
+    return smtplib._quote_periods(smtplib._fix_eols(msg.as_string()).encode('ascii'))
+
+
+def new_path(image, html):
+    img = river.build_image_part(image, 'photo.png')
+    html_part = MIMEText(html, 'html', policy=river.SMTP_POLICY)
+    msg = river.build_message(CONFIG, 'to@example.com', 'Bench', 'Bench', html_part, img)
+    return smtplib._quote_periods(river.message_bytes(msg))
+
+
+def measure(func, image, html, iterations):
+    func(image, html)  # warm up (and fill the image cache for the new path)
+    start = time.perf_counter()
+    total = 0
+    for _ in range(iterations):
+        total += len(func(image, html))
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(image, html)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'messages_per_second': iterations / elapsed,
+        'megabytes_per_second': total / elapsed / 1e6,
+        'peak_allocated_bytes': peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100000,1000000,5000000', help="image sizes in bytes")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    html = river.render_email_html('Bench', 'Hello from the benchmark', True)
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        image = b'\x89PNG\r\n\x1a\n' + os.urandom(size)
+        river.IMAGE_PART_CACHE = river.LRUCache(river.IMAGE_PART_CACHE_ENTRIES, river.IMAGE_PART_CACHE_BYTES)
+        result = {
+            'image_bytes': size,
+            'before': measure(old_path, image, html, args.iterations),
+            'after': measure(new_path, image, html, args.iterations),
+        }
+        result['speedup'] = result['after']['megabytes_per_second'] / result['before']['megabytes_per_second']
+        results.append(result)
+        print(f"{size:>10} bytes  before {result['before']['megabytes_per_second']:8.1f} MB/s "
+              f"peak {result['before']['peak_allocated_bytes'] / 1e6:7.1f} MB  |  "
+              f"after {result['after']['megabytes_per_second']:8.1f} MB/s "
+              f"peak {result['after']['peak_allocated_bytes'] / 1e6:7.1f} MB  |  x{result['speedup']:.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
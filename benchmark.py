@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark: runs SMTP River against a local fake SMTP server and
+drives /login and /send_message with concurrent clients.
+
+    python benchmark.py [-c 16] [-n 500] [--image-sizes 0,100000,1000000]
+                        [--smtp-latency 0.02] [--tls] [--fail-rate 0.05] [--output benchmark.json]
+
+Every scenario gets a fresh app process, database and SMTP server, so peak RSS
+and SMTP session counts belong to that scenario alone.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse as urlparse
+
+from loadtest import LoadTest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_SCRIPT = os.path.join(HERE, 'smtp_river_no_duplicate.py')
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+SENDER = 'bench@example.com'
+STARTUP_TIMEOUT = 15
+
+
+# Fake SMTP server
+class FakeSMTPHandler(socketserver.BaseRequestHandler):
+    """Replies wait until the client stops sending and waits for them, then go
+    out together after one round trip of latency, as on a real network: a
+    pipelined batch of commands pays the latency once."""
+
+    def setup(self):
+        self.sock = self.request
+        self.buffer = b''
+        self.pos = 0
+        self.pending = []
+
+    def finish(self):
+        try:
+            self.flush()
+        except OSError:
+            pass
+
+    def reply(self, line):
+        self.pending.append(line.encode('ascii') + b'\r\n')
+
+    def flush(self):
+        if self.pending:
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.sock.sendall(b''.join(self.pending))
+            self.pending = []
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b'\n', self.pos)
+            if end >= 0:
+                line = self.buffer[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+            self.flush()
+            data = self.sock.recv(65536)
+            if not data:
+                return b''
+            self.buffer = self.buffer[self.pos:] + data
+            self.pos = 0
+
+    def read_data(self):
+        size = 0
+        while True:
+            line = self.readline()
+            if line in (b'.\r\n', b''):
+                return size
+            size += len(line)
+
+    def handle(self):
+        server = self.server
+        server.count('sessions')
+        self.reply('220 fake-smtp ESMTP ready')
+        tls = False
+        accepted = 0
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                lines = ['fake-smtp', 'PIPELINING', '8BITMIME', 'SIZE 52428800']
+                if server.ssl_context and not tls:
+                    lines.append('STARTTLS')
+                lines.append('AUTH PLAIN LOGIN')
+                self.reply('\r\n'.join(f'250-{text}' for text in lines[:-1]) + f'\r\n250 {lines[-1]}')
+            elif verb == 'HELO':
+                self.reply('250 fake-smtp')
+            elif verb == 'STARTTLS' and server.ssl_context and not tls:
+                self.reply('220 Ready to start TLS')
+                self.flush()
+                self.sock = server.ssl_context.wrap_socket(self.sock, server_side=True)
+                tls = True
+            elif verb == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                accepted = 0
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                outcome = server.inject()
+                if outcome == 'drop':
+                    server.count('dropped')
+                    return
+                if outcome == 'defer':
+                    server.count('deferred')
+                    self.reply('451 Try again later')
+                elif outcome == 'reject':
+                    server.count('rejected')
+                    self.reply('550 No such user')
+                else:
+                    accepted += 1
+                    self.reply('250 OK')
+            elif verb == 'DATA' and not accepted:
+                self.reply('554 No valid recipients')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = self.read_data()
+                server.count('messages')
+                server.count('bytes', size)
+                self.reply('250 OK queued')
+            elif verb in ('NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """An SMTP sink with artificial round-trip latency and random RCPT failures.
+
+    fail_rate answers RCPT with 451, reject_rate with 550, and drop_rate
+    closes the connection instead of answering.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, ssl_context=None,
+                 fail_rate=0.0, reject_rate=0.0, drop_rate=0.0, seed=None):
+        super().__init__(address, FakeSMTPHandler)
+        self.latency = latency
+        self.ssl_context = ssl_context
+        self.fail_rate = fail_rate
+        self.reject_rate = reject_rate
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {'sessions': 0, 'messages': 0, 'bytes': 0, 'deferred': 0, 'rejected': 0, 'dropped': 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def inject(self):
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.drop_rate:
+            return 'drop'
+        roll -= self.drop_rate
+        if roll < self.fail_rate:
+            return 'defer'
+        roll -= self.fail_rate
+        if roll < self.reject_rate:
+            return 'reject'
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def self_signed_context(workdir, cert=None, key=None):
+    if not cert:
+        cert = os.path.join(workdir, 'cert.pem')
+        key = os.path.join(workdir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+# The app under test
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AppProcess:
+    """smtp_river_no_duplicate.py running in its own directory, config and database."""
+
+    def __init__(self, workdir, smtp_port, tls, app_args=()):
+        self.workdir = workdir
+        self.port = free_port()
+        self.smtp_port = smtp_port
+        self.tls = tls
+        self.app_args = list(app_args)
+        self.process = None
+        self.cookie = None
+
+    def start(self):
+        # Every scenario request posts the same message; dedup would coalesce all but the first
+        with open(os.path.join(self.workdir, 'smtp_config.json'), 'w') as f:
+            json.dump({'smtp_server': '127.0.0.1', 'smtp_port': self.smtp_port, 'your_email': SENDER,
+                       'app_password': 'bench', 'smtp_starttls': self.tls, 'dedup_window': 0}, f)
+        with open(os.path.join(self.workdir, 'users.json'), 'w') as f:
+            json.dump({USERNAME: {'password': PASSWORD, 'email': SENDER}}, f)
+        self.log = open(os.path.join(self.workdir, 'app.log'), 'wb')
+        self.process = subprocess.Popen(
+            [sys.executable, APP_SCRIPT, '--host', '127.0.0.1', '--port', str(self.port)] + self.app_args,
+            cwd=self.workdir, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"App exited with {self.process.returncode}; see {self.log.name}")
+            try:
+                self.request('GET', '/login')
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("App did not start listening")
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+            return response
+        finally:
+            conn.close()
+
+    def login(self):
+        body = urlparse.urlencode({'username': USERNAME, 'password': PASSWORD})
+        response = self.request('POST', '/login', body,
+                                {'Content-Type': 'application/x-www-form-urlencoded'})
+        cookies = [header.split(';', 1)[0] for header in response.headers.get_all('Set-Cookie') or []]
+        if response.status != 200 or not cookies:
+            raise RuntimeError(f"Login failed with HTTP {response.status}")
+        self.cookie = '; '.join(cookies)
+        return self.cookie
+
+    def queue_stats(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request('GET', '/stats', headers={'Cookie': self.cookie})
+            return json.loads(conn.getresponse().read())['delivery_queue']
+        finally:
+            conn.close()
+
+    def wait_drained(self, timeout):
+        """Wait until no job is queued or being sent; retries pushed past the
+        timeout by backoff leave it undrained."""
+        deadline = time.monotonic() + timeout
+        while True:
+            queue = self.queue_stats()
+            if not queue.get('queued') and not queue.get('sending'):
+                return True, queue
+            if time.monotonic() >= deadline:
+                return False, queue
+            time.sleep(0.1)
+
+    def peak_rss_kb(self):
+        # Linux only: the high-water mark of resident memory
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+
+# Scenarios
+def multipart_body(fields, file_field=None, filename=None, data=None):
+    boundary = f'bench{random.getrandbits(64):016x}'
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    if file_field:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                     f'Content-Type: image/png\r\n\r\n'.encode('utf-8') + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('ascii'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def fake_image(size):
+    # PNG signature then noise: attached as-is unless image resizing is configured
+    return b'\x89PNG\r\n\x1a\n' + os.urandom(max(0, size - 8))
+
+
+def scenarios(image_sizes):
+    fields = {'sender_name': 'Bench', 'recipient': 'someone@example.net', 'subject': 'Benchmark',
+              'message': 'Hello from the benchmark. ' * 20}
+    yield 'login', '/login', urlparse.urlencode({'username': USERNAME, 'password': PASSWORD}).encode('ascii'), \
+        'application/x-www-form-urlencoded', False
+    for size in image_sizes:
+        if size:
+            body, content_type = multipart_body(fields, 'photo', 'photo.png', fake_image(size))
+            yield f'send_message_image_{size}', '/send_message', body, content_type, True
+        else:
+            yield 'send_message', '/send_message', urlparse.urlencode(fields).encode('utf-8'), \
+                'application/x-www-form-urlencoded', True
+
+
+def run_scenario(args, name, path, body, content_type, sends):
+    workdir = tempfile.mkdtemp(prefix='smtp-river-bench-')
+    smtp = app = None
+    try:
+        context = self_signed_context(workdir, args.cert, args.key) if args.tls else None
+        smtp = FakeSMTPServer(latency=args.smtp_latency, ssl_context=context, fail_rate=args.fail_rate,
+                              reject_rate=args.reject_rate, drop_rate=args.drop_rate, seed=args.seed).start()
+        app_args = ['--workers', str(args.workers)] + (['--keep-alive'] if args.keep_alive else [])
+        app = AppProcess(workdir, smtp.server_address[1], args.tls, app_args).start()
+        cookie = app.login()
+        headers = {'Content-Type': content_type}
+        if sends:
+            headers['Cookie'] = cookie
+        test = LoadTest(f'http://127.0.0.1:{app.port}{path}', 'POST', body, headers, args.keep_alive)
+        start = time.perf_counter()
+        report = test.run(args.concurrency, requests=args.requests or None, duration=None if args.requests else args.duration)
+        result = {
+            'scenario': name,
+            'request_bytes': len(body),
+            'requests': report['requests'],
+            'errors': report['errors'],
+            'statuses': report['statuses'],
+            'requests_per_second': report['requests_per_second'],
+            'latency_ms': report['latency_ms'],
+        }
+        if sends:
+            drained, queue = app.wait_drained(args.drain_timeout)
+            elapsed = time.perf_counter() - start
+            delivered = smtp.stats()['messages']
+            result['delivery'] = {
+                'drained': drained,
+                'seconds': elapsed,
+                'messages_per_second': delivered / elapsed if elapsed else 0.0,
+                'queue': queue,
+            }
+        result['peak_rss_kb'] = app.peak_rss_kb()
+        result['smtp'] = smtp.stats()
+        result['smtp_sessions_opened'] = result['smtp']['sessions']
+        return result
+    finally:
+        if app:
+            app.stop()
+        if smtp:
+            smtp.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SMTP River end to end against a fake SMTP server")
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-n', '--requests', type=int, default=500, help="requests per scenario (0: use --duration)")
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--image-sizes', default='0,100000,1000000,5000000',
+                        help="comma-separated image sizes in bytes; 0 sends without an image")
+    parser.add_argument('--scenario', action='append', help="only run scenarios with these names")
+    parser.add_argument('--workers', type=int, default=16, help="app HTTP worker threads")
+    parser.add_argument('--keep-alive', action='store_true', help="HTTP/1.1 persistent connections")
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help="SMTP round-trip time in seconds")
+    parser.add_argument('--tls', action='store_true', help="offer STARTTLS (the app upgrades every session)")
+    parser.add_argument('--cert', help="PEM certificate for --tls (default: generate one with openssl)")
+    parser.add_argument('--key', help="PEM key for --cert")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="fraction of RCPTs answered 451")
+    parser.add_argument('--reject-rate', type=float, default=0.0, help="fraction of RCPTs answered 550")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="fraction of RCPTs answered by hanging up")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help="seconds to wait for queued messages to be delivered")
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    image_sizes = [int(size) for size in args.image_sizes.split(',') if size.strip()]
+    results = []
+    for name, path, body, content_type, sends in scenarios(image_sizes):
+        if args.scenario and name not in args.scenario:
+            continue
+        result = run_scenario(args, name, path, body, content_type, sends)
+        results.append(result)
+        latency = result['latency_ms']
+        print(f"{name:32} {result['requests_per_second']:9.1f} req/s  p50 {latency['p50']:7.1f}ms  "
+              f"p95 {latency['p95']:7.1f}ms  p99 {latency['p99']:7.1f}ms  "
+              f"rss {result['peak_rss_kb'] or 0:8d}kB  smtp sessions {result['smtp_sessions_opened']}")
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'scenarios': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
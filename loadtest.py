@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Concurrent HTTP load generator for SMTP River.
+
+Example:
+    python loadtest.py http://localhost:8080/login -c 32 -d 10
+    python loadtest.py http://localhost:8080/ -c 16 -n 2000 --cookie smtp_river_session=TOKEN --keep-alive
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse as urlparse
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTest:
+    def __init__(self, url, method='GET', body=None, headers=None, keep_alive=False, timeout=30):
+        parsed = urlparse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        self.method = method
+        self.body = body
+        self.headers = dict(headers or {})
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _worker(self, next_request, deadline):
+        conn = None
+        latencies = []
+        errors = 0
+        statuses = {}
+        while next_request() and time.monotonic() < deadline:
+            if conn is None:
+                conn = self._connect()
+            start = time.perf_counter()
+            try:
+                conn.request(self.method, self.path, body=self.body, headers=self.headers)
+                response = conn.getresponse()
+                response.read()
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+                if not self.keep_alive or response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+            for status, count in statuses.items():
+                self.statuses[status] = self.statuses.get(status, 0) + count
+
+    def run(self, concurrency, requests=None, duration=None):
+        remaining = [requests]
+        lock = threading.Lock()
+
+        def next_request():
+            if remaining[0] is None:
+                return True
+            with lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+                return True
+
+        deadline = time.monotonic() + duration if duration else float('inf')
+        threads = [threading.Thread(target=self._worker, args=(next_request, deadline))
+                   for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return self.report(concurrency, elapsed)
+
+    def report(self, concurrency, elapsed):
+        latencies = sorted(self.latencies)
+        return {
+            'url': f'http://{self.host}:{self.port}{self.path}',
+            'method': self.method,
+            'concurrency': concurrency,
+            'keep_alive': self.keep_alive,
+            'requests': len(latencies),
+            'errors': self.errors,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'elapsed_seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+                'p50': percentile(latencies, 50) * 1000,
+                'p95': percentile(latencies, 95) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'max': latencies[-1] * 1000 if latencies else 0.0,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure requests/sec and latency percentiles of an HTTP endpoint")
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=10)
+    parser.add_argument('-n', '--requests', type=int, help="total requests (default: run for --duration)")
+    parser.add_argument('-d', '--duration', type=float, default=10, help="seconds to run when -n is not given")
+    parser.add_argument('-m', '--method', default='GET')
+    parser.add_argument('--data', help="request body")
+    parser.add_argument('--data-file', help="read the request body from a file")
+    parser.add_argument('-H', '--header', action='append', default=[], help="extra header, 'Name: value'")
+    parser.add_argument('--cookie', help="Cookie header value")
+    parser.add_argument('--keep-alive', action='store_true', help="reuse one connection per client")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+
+    body = args.data.encode('utf-8') if args.data else None
+    if args.data_file:
+        with open(args.data_file, 'rb') as f:
+            body = f.read()
+    headers = {}
+    for header in args.header:
+        name, value = header.split(':', 1)
+        headers[name.strip()] = value.strip()
+    if args.cookie:
+        headers['Cookie'] = args.cookie
+    if body is not None and 'Content-Type' not in headers:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    test = LoadTest(args.url, args.method.upper(), body, headers, args.keep_alive, args.timeout)
+    report = test.run(args.concurrency, requests=args.requests, duration=None if args.requests else args.duration)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
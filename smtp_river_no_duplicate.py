@@ -2,32 +2,2951 @@
 import smtplib
 import os
 import json
+import math
+import mimetypes
+import multiprocessing
+import queue
+import re
+import secrets
+import signal
+import socket
+import sys
+import argparse
 import base64
+import bisect
+import csv
+import getpass
+import hashlib
+import hmac
+import io
+import sqlite3
+import tempfile
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
+from email.generator import BytesGenerator
+from email.parser import HeaderParser
+from email.policy import compat32
+from html import escape
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse as urlparse
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
+
 # Configuration
 CONFIG_FILE = "smtp_config.json"
 USER_FILE = "users.json"
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+CONFIG_CHECK_INTERVAL = 1.0      # seconds between stat() checks for edits
+
+# Metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_text(key):
+    if not key:
+        return ''
+    pairs = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in key)
+    return '{' + pairs + '}'
+
+
+class Metrics:
+    """Counters, gauges and histograms exposed in the Prometheus text format.
+
+    stage() times one step of a request or delivery; when a trace is open on
+    the current thread the step is also added to it for the timing log.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.timing_log = False
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._series = {}
+        self._collectors = []
+        self._trace = threading.local()
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+        self._series.setdefault(name, {})
+
+    def add_collector(self, collector):
+        # collector() returns [(name, kind, help, [(labels dict, value), ...]), ...]
+        self._collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            histogram = series.get(key)
+            if histogram is None:
+                # One count per bucket plus +Inf, then the running sum
+                histogram = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('smtp_river_stage_seconds', elapsed, stage=name)
+            stages = getattr(self._trace, 'stages', None)
+            if stages is not None:
+                stages.append((name, elapsed))
+
+    def trace_begin(self):
+        self._trace.stages = []
+
+    def trace_end(self, label, elapsed):
+        stages = getattr(self._trace, 'stages', None) or []
+        self._trace.stages = None
+        if self.timing_log:
+            detail = ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in stages)
+            print(f"timing {label} total={elapsed * 1000:.1f}ms {detail}".rstrip())
+
+    def _render_series(self, lines, name, kind, help_text, series):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{_label_text(key)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_label_text(key + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(key)} {value[-1]}')
+            lines.append(f'{name}_count{_label_text(key)} {cumulative}')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            snapshot = [(name, kind, help_text, [(key, list(value) if isinstance(value, list) else value)
+                                                 for key, value in self._series[name].items()])
+                        for name, (kind, help_text) in self._meta.items()]
+        for name, kind, help_text, series in snapshot:
+            self._render_series(lines, name, kind, help_text, series)
+        for collector in self._collectors:
+            for name, kind, help_text, samples in collector():
+                series = [(tuple(sorted(labels.items())), value) for labels, value in samples]
+                self._render_series(lines, name, kind, help_text, series)
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+METRICS.describe('smtp_river_http_requests_total', 'counter', "HTTP requests by method, route and status.")
+METRICS.describe('smtp_river_http_request_seconds', 'histogram', "HTTP request handling time.")
+METRICS.describe('smtp_river_http_in_flight', 'gauge', "HTTP requests being handled.")
+METRICS.describe('smtp_river_stage_seconds', 'histogram', "Time spent in each stage of a request or send.")
+METRICS.describe('smtp_river_sends_total', 'counter', "Delivery attempts by outcome.")
+METRICS.describe('smtp_river_sends_in_flight', 'gauge', "Messages currently being delivered.")
+METRICS.describe('smtp_river_recipients_rejected_total', 'counter', "Recipients refused by validation before delivery.")
+METRICS.describe('smtp_river_throttled_total', 'counter', "Sends held back by a rate limit, by limiting bucket.")
+METRICS.describe('smtp_river_relay_demotions_total', 'counter', "Relays taken out of rotation after an error.")
+METRICS.describe('smtp_river_duplicates_total', 'counter',
+                 "Repeated messages coalesced into an already queued job, by where the repeat was caught.")
+METRICS.describe('smtp_river_throttle_wait_seconds', 'histogram', "How long throttled sends were deferred.")
+
+
+def send_outcome(error):
+    if error is None:
+        return 'sent'
+    if isinstance(error, smtplib.SMTPAuthenticationError) or (isinstance(error, NoRelayAvailable)
+                                                              and error.login_rejected):
+        return 'auth_failure'
+    return 'error'
+
+
+# SMTP connection pool
+SMTP_TIMEOUT = 30
+SMTP_POOL_IDLE_TIMEOUT = 60      # seconds an idle session is kept open
+SMTP_POOL_MAX_MESSAGES = 100     # messages sent before a session is recycled
+SMTP_POOL_MAX_IDLE = 4           # idle sessions kept per (server, port, account)
+SMTP_POOL_NOOP_AFTER = 5         # idle seconds after which NOOP checks liveness
+SMTP_POLICY = compat32.clone(linesep='\r\n')
+
+
+def send_envelope(server, from_addr, to_addrs, msg):
+    """sendmail(), but with MAIL, every RCPT and DATA in a single write when the
+    server offers PIPELINING (RFC 2920): one round trip instead of 2 + recipients."""
+    server.ehlo_or_helo_if_needed()
+    if not server.has_extn('pipelining'):
+        return server.sendmail(from_addr, to_addrs, msg)
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    if isinstance(msg, str):
+        msg = smtplib._fix_eols(msg).encode('ascii')
+    size = f' SIZE={len(msg)}' if server.has_extn('size') else ''
+    commands = [f'MAIL FROM:{smtplib.quoteaddr(from_addr)}{size}']
+    commands += [f'RCPT TO:{smtplib.quoteaddr(addr)}' for addr in to_addrs]
+    commands.append('DATA')
+    server.send(''.join(command + '\r\n' for command in commands))
+    replies = [server.getreply() for _ in commands]
+    (mail_code, mail_reply), (data_code, data_reply) = replies[0], replies[-1]
+    refused = {addr: reply for addr, reply in zip(to_addrs, replies[1:-1]) if reply[0] not in (250, 251)}
+    if data_code == 354 and (mail_code != 250 or len(refused) == len(to_addrs)):
+        # DATA shouldn't be accepted without an envelope; finish it empty
+        server.send('.\r\n')
+        data_code, data_reply = server.getreply()
+    if 421 in (mail_code, data_code) or any(code == 421 for code, _ in refused.values()):
+        server.close()
+    if mail_code != 250:
+        if mail_code != 421:
+            server._rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_reply, from_addr)
+    if len(refused) == len(to_addrs) or any(code == 421 for code, _ in refused.values()):
+        if data_code != 421:
+            server._rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if data_code != 354:
+        if data_code != 421:
+            server._rset()
+        raise smtplib.SMTPDataError(data_code, data_reply)
+    body = smtplib._quote_periods(msg)
+    if body[-2:] != b'\r\n':
+        body += b'\r\n'
+    server.send(body + b'.\r\n')
+    code, reply = server.getreply()
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            server._rset()
+        raise smtplib.SMTPDataError(code, reply)
+    return refused
+
+
+class PooledConnection:
+    def __init__(self, key, server):
+        self.key = key
+        self.server = server
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPConnectionPool:
+    """Authenticated SMTP sessions reused across sends, keyed by (server, port, account)."""
+
+    def __init__(self, idle_timeout=SMTP_POOL_IDLE_TIMEOUT, max_messages=SMTP_POOL_MAX_MESSAGES,
+                 max_idle=SMTP_POOL_MAX_IDLE):
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'handshakes': 0,
+            'handshake_seconds': 0.0,
+            'reconnects': 0,
+            'closed': 0,
+            'pipelined': 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _key(self, config):
+        return (config['smtp_server'], int(config['smtp_port']), config['your_email'])
+
+    def _connect(self, config):
+        start = time.monotonic()
+        with METRICS.stage('connect'):
+            server = smtplib.SMTP(config['smtp_server'], config['smtp_port'], timeout=SMTP_TIMEOUT)
+        try:
+            if config.get('smtp_starttls', True):
+                with METRICS.stage('starttls'):
+                    server.starttls()
+            with METRICS.stage('auth'):
+                server.login(config['your_email'], config['app_password'])
+        except Exception:
+            self._close(server)
+            raise
+        self._count('handshakes')
+        self._count('handshake_seconds', time.monotonic() - start)
+        return PooledConnection(self._key(config), server)
+
+    def _close(self, server):
+        try:
+            with METRICS.stage('quit'):
+                server.quit()
+        except Exception:
+            server.close()
+        self._count('closed')
+
+    def _alive(self, conn):
+        if time.monotonic() - conn.last_used < SMTP_POOL_NOOP_AFTER:
+            return True
+        try:
+            return conn.server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self, config):
+        key = self._key(config)
+        idle_timeout = config.get('pool_idle_timeout', self.idle_timeout)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+            if conn is None:
+                break
+            if time.monotonic() - conn.last_used > idle_timeout or not self._alive(conn):
+                self._close(conn.server)
+                continue
+            self._count('hits')
+            return conn
+        self._count('misses')
+        return self._connect(config)
+
+    def release(self, conn, config):
+        max_messages = config.get('pool_max_messages', self.max_messages)
+        if conn.messages >= max_messages:
+            self._close(conn.server)
+            return
+        conn.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(conn.key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        self._close(conn.server)
+
+    def discard(self, conn):
+        conn.server.close()
+        self._count('closed')
+
+    def send(self, config, from_addr, to_addrs, msg):
+        # A session dropped by the relay (421, timeout, reset) is replaced once
+        for attempt in range(2):
+            conn = self.acquire(config)
+            try:
+                with METRICS.stage('data'):
+                    result = send_envelope(conn.server, from_addr, to_addrs, msg)
+                if conn.server.has_extn('pipelining'):
+                    self._count('pipelined')
+            except (smtplib.SMTPServerDisconnected, TimeoutError, ConnectionError):
+                self.discard(conn)
+                if attempt:
+                    raise
+                self._count('reconnects')
+                continue
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code != 421:
+                    self.release(conn, config)
+                    raise
+                self.discard(conn)
+                if attempt:
+                    raise
+                self._count('reconnects')
+                continue
+            except smtplib.SMTPRecipientsRefused:
+                self.release(conn, config)
+                raise
+            except Exception:
+                self.discard(conn)
+                raise
+            conn.messages += 1
+            self.release(conn, config)
+            return result
+
+    def close_all(self):
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in conns:
+            self._close(conn.server)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['idle'] = sum(len(idle) for idle in self._idle.values())
+        stats['avg_handshake_seconds'] = stats['handshake_seconds'] / stats['handshakes'] if stats['handshakes'] else 0.0
+        return stats
+
+
+SMTP_POOL = SMTPConnectionPool()
+
+
+# Relays - "relays" in smtp_config.json lists accounts to spread sends over:
+#   [{"smtp_server": ..., "smtp_port": 587, "your_email": ..., "app_password": ...,
+#     "weight": 2, "daily_quota": 500}, ...]
+# Without it the top-level account is the only relay.
+RELAY_AUTH_COOLDOWN = 600        # seconds a relay that rejected its login is skipped
+RELAY_QUOTA_COOLDOWN = 3600      # seconds a relay that reported its quota used up is skipped
+RELAY_ERROR_COOLDOWN = 30        # seconds an unreachable relay is skipped
+QUOTA_PATTERN = re.compile(r'quota|limit exceeded|too many (messages|recipients)|5\.4\.5|4\.7\.28', re.I)
+
+
+class NoRelayAvailable(Exception):
+    """Every relay is demoted or over its daily quota; retry_at is when the first one is back.
+
+    login_rejected is set when every relay is out for rejecting its login, which
+    waiting won't fix.
+    """
+
+    def __init__(self, message, retry_at, login_rejected=False):
+        super().__init__(message)
+        self.retry_at = retry_at
+        self.login_rejected = login_rejected
+
+
+def next_quota_reset():
+    # Daily quotas count from local midnight
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight + timedelta(days=1)).timestamp()
+
+
+def relay_configs(config):
+    """The accounts to send through, each merged over the top-level settings."""
+    relays = config.get('relays')
+    if relays is None:
+        relays = [{}] if config.get('your_email') and config.get('app_password') else []
+    return [dict(config, **relay) for relay in relays]
+
+
+def relay_cooldown(e):
+    """How long to avoid a relay after this error, or None if the error isn't the relay's fault."""
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return RELAY_AUTH_COOLDOWN
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return RELAY_ERROR_COOLDOWN
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        replies = [reply for _, reply in e.recipients.values()]
+    elif isinstance(e, smtplib.SMTPResponseException):
+        if e.smtp_code == 421:
+            return RELAY_ERROR_COOLDOWN
+        replies = [e.smtp_error]
+    elif isinstance(e, smtplib.SMTPException) or not isinstance(e, OSError):
+        return None
+    else:
+        # Refused, reset, timed out or unresolvable
+        return RELAY_ERROR_COOLDOWN
+    if replies and all(QUOTA_PATTERN.search(reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else str(reply))
+                       for reply in replies):
+        return RELAY_QUOTA_COOLDOWN
+    return None
+
+
+def relay_label(relay, index):
+    # /metrics needs no login, so relays are labelled by their "name" or position, not their address
+    return str(relay.get('name') or index)
+
+
+class RelayState:
+    def __init__(self, relay):
+        self.name = relay['your_email']
+        self.label = None
+        self.in_flight = 0
+        self.sent = 0
+        self.day = None
+        self.demoted_until = 0.0
+        self.last_error = None
+        self.login_rejected = False
+
+
+class RelayRouter:
+    """Spreads sends over the configured relay accounts.
+
+    Each send goes to the healthy relay with the least load for its weight,
+    counting messages sent today and in flight. A relay that rejects
+    its login, reports its quota used up or can't be reached is demoted for a
+    cooldown, and the send moves on to the next relay.
+
+    Sends through relays with a daily_quota are counted in emails.db once
+    init_db() has run, so a restart doesn't hand out the quota again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+        # Fraction of each daily_quota this process may use (1/N with N worker processes)
+        self.share = 1.0
+        self._persist = False
+
+    def init_db(self):
+        db = get_db()
+        db.execute('''CREATE TABLE IF NOT EXISTS relay_sends
+                 (account TEXT NOT NULL,
+                  day TEXT NOT NULL,
+                  sent INTEGER NOT NULL,
+                  PRIMARY KEY (account, day)) WITHOUT ROWID''')
+        db.execute('DELETE FROM relay_sends WHERE day < ?', (time.strftime('%Y-%m-%d'),))
+        db.commit()
+        self._persist = True
+
+    def _sent_today(self, relay, today):
+        if not (self._persist and relay.get('daily_quota')):
+            return 0
+        row = get_db().execute('SELECT sent FROM relay_sends WHERE account = ? AND day = ?',
+                               (relay['your_email'], today)).fetchone()
+        # Every worker process takes its share of what has gone out already
+        return math.ceil(row['sent'] * self.share) if row else 0
+
+    def _record(self, relay, day, count):
+        if not (self._persist and relay.get('daily_quota') and count):
+            return
+        db = get_db()
+        db.execute('''INSERT INTO relay_sends (account, day, sent) VALUES (?, ?, ?)
+                      ON CONFLICT (account, day) DO UPDATE SET sent = sent + excluded.sent''',
+                   (relay['your_email'], day, count))
+        db.commit()
+
+    def _choose(self, relays, tried):
+        now = time.time()
+        today = time.strftime('%Y-%m-%d')
+        best = None
+        with self._lock:
+            for index, relay in enumerate(relays):
+                key = SMTP_POOL._key(relay)
+                if key in tried:
+                    continue
+                state = self._state.get(key)
+                if state is None:
+                    state = self._state[key] = RelayState(relay)
+                state.label = relay_label(relay, index)
+                if state.day != today:
+                    state.day, state.sent = today, self._sent_today(relay, today)
+                if state.demoted_until > now:
+                    continue
+                if relay.get('daily_quota') and state.sent >= relay['daily_quota'] * self.share:
+                    continue
+                # A relay whose account limit has a token free goes before a busier one that must wait
+                score = (RATE_LIMITER.delay('account', relay['your_email']),
+                         (state.sent + state.in_flight) / (relay.get('weight') or 1))
+                if best is None or score < best[0]:
+                    best = (score, key, relay, state)
+            if len(self._state) > len(relays):
+                # Relays taken out of the config go, or their labels could clash with the new ones
+                current = {SMTP_POOL._key(relay) for relay in relays}
+                for key in [key for key in self._state if key not in current]:
+                    del self._state[key]
+            if best is None:
+                return None
+            best[3].in_flight += 1
+            return best[1:]
+
+    def send(self, config, to_addrs, build):
+        """Send build(relay) - the message bytes for that relay - through the best relay."""
+        relays = relay_configs(config)
+        tried = set()
+        error = None
+        while True:
+            choice = self._choose(relays, tried)
+            if choice is None:
+                # Only errors that demoted a relay get here; the others are raised as they happen
+                detail = f": {error}" if error is not None else ''
+                raise NoRelayAvailable(f"No SMTP relay available - all demoted or over quota{detail}",
+                                       self.available_at(relays), self.login_rejected(relays))
+            key, relay, state = choice
+            tried.add(key)
+            try:
+                wait, _ = RATE_LIMITER.reserve((('account', relay['your_email']),))
+                if wait:
+                    # Every relay's account is over its limit; this one has the first turn
+                    time.sleep(wait)
+                result = SMTP_POOL.send(relay, relay['your_email'], to_addrs, build(relay))
+            except Exception as e:
+                cooldown = relay_cooldown(e)
+                if cooldown is None:
+                    raise
+                self.demote(state, cooldown, e)
+                error = e
+                continue
+            else:
+                # Quotas count recipients, not envelopes
+                count = 1 if isinstance(to_addrs, str) else len(to_addrs) - len(result)
+                with self._lock:
+                    state.sent += count
+                self._record(relay, state.day, count)
+                return result
+            finally:
+                with self._lock:
+                    state.in_flight -= 1
+
+    def available_at(self, relays):
+        """When the first of these relays is out of its cooldown and under its quota again."""
+        now = time.time()
+        today = time.strftime('%Y-%m-%d')
+        times = []
+        with self._lock:
+            for relay in relays:
+                state = self._state.get(SMTP_POOL._key(relay))
+                if state is None:
+                    return now
+                over_quota = (relay.get('daily_quota') and state.day == today
+                              and state.sent >= relay['daily_quota'] * self.share)
+                times.append(max(state.demoted_until, next_quota_reset() if over_quota else now))
+        return min(times, default=now)
+
+    def login_rejected(self, relays):
+        """Whether every one of these relays is demoted for rejecting its login."""
+        now = time.time()
+        with self._lock:
+            states = [self._state.get(SMTP_POOL._key(relay)) for relay in relays]
+            return bool(states) and all(state is not None and state.demoted_until > now and state.login_rejected
+                                        for state in states)
+
+    def demote(self, state, cooldown, error):
+        print(f"Relay {state.name} demoted for {cooldown}s: {error}")
+        METRICS.inc('smtp_river_relay_demotions_total', relay=state.label)
+        if isinstance(error, smtplib.SMTPAuthenticationError):
+            METRICS.inc('smtp_river_sends_total', outcome=send_outcome(error))
+        with self._lock:
+            state.demoted_until = time.time() + cooldown
+            state.last_error = str(error)
+            state.login_rejected = isinstance(error, smtplib.SMTPAuthenticationError)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {state.name: {'label': state.label, 'sent_today': state.sent, 'in_flight': state.in_flight,
+                                 'healthy': state.demoted_until <= now, 'last_error': state.last_error}
+                    for state in self._state.values()}
+
+
+RELAYS = RelayRouter()
+
+
+class JsonFileCache:
+    """A parsed JSON file kept in memory and reloaded when it changes on disk.
+
+    The file is stat()ed at most once per check_interval; a changed inode,
+    mtime or size triggers a reparse. If the new contents don't parse, the
+    last good version keeps being served.
+    """
+
+    def __init__(self, path, default, check_interval=CONFIG_CHECK_INTERVAL, transform=None):
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+        self.transform = transform
+        self._lock = threading.Lock()
+        self._value = None
+        self._signature = None
+        self._checked = 0.0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self):
+        if self._value is not None and time.monotonic() - self._checked < self.check_interval:
+            return self._value
+        with self._lock:
+            now = time.monotonic()
+            if self._value is None or now - self._checked >= self.check_interval:
+                self._checked = now
+                signature = self._stat()
+                if self._value is None or signature != self._signature:
+                    self._reload(signature)
+            return self._value
+
+    def _reload(self, signature):
+        if signature is None:
+            value = self.transform(self.default) if self.transform else self.default
+        else:
+            try:
+                with open(self.path, 'r') as f:
+                    value = json.load(f)
+                if self.transform:
+                    value = self.transform(value)
+            except (OSError, ValueError) as e:
+                if self._value is None:
+                    raise
+                print(f"Keeping previous {self.path}: {e}")
+                self._signature = signature
+                return
+        self._value = value
+        self._signature = signature
+
+
+# Passwords
+PASSWORD_ITERATIONS = 200000
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS):
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+
+def verify_password(password_hash, password):
+    try:
+        algorithm, iterations, salt, expected = password_hash.split('$')
+        if algorithm != 'pbkdf2_sha256':
+            return False
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+# Checked against when the username doesn't exist; matches no password
+UNKNOWN_USER_HASH = f"pbkdf2_sha256${PASSWORD_ITERATIONS}${'A' * 22}==${'A' * 43}="
+
+
+def hash_legacy_passwords(users):
+    """Replace plaintext "password" entries with a "password_hash" as users.json is loaded."""
+    hashed = {}
+    for username, user in users.items():
+        user = dict(user)
+        if 'password_hash' not in user and 'password' in user:
+            print(f"User {username!r} has a plaintext password; store a password_hash "
+                  f"(python smtp_river_no_duplicate.py --hash-password)")
+            user['password_hash'] = hash_password(user['password'])
+        user.pop('password', None)
+        hashed[username] = user
+    return hashed
+
+
+CONFIG_CACHE = JsonFileCache(
+    CONFIG_FILE, {"smtp_server": "smtp.gmail.com", "smtp_port": 587, "your_email": "", "app_password": ""})
+USERS_CACHE = JsonFileCache(
+    USER_FILE, {"admin": {"password": "admin123", "email": "admin@localhost"}}, transform=hash_legacy_passwords)
+
+
+def load_config():
+    with METRICS.stage('config_load'):
+        return CONFIG_CACHE.get()
+
+
+def load_users():
+    return USERS_CACHE.get()
+
+
+# Message building
+IMAGE_PART_CACHE_ENTRIES = 64
+IMAGE_PART_CACHE_BYTES = 128 * 1024 * 1024
+MESSAGE_BUFFER_KEEP = 8 * 1024 * 1024   # larger per-thread generator buffers are released after use
+
+
+class LRUCache:
+    """Thread-safe least-recently-used map bounded by entry count and, optionally, total size."""
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._items and (len(self._items) > self.max_entries
+                                   or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            self._bytes -= item[1]
+            return item[0]
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+# Encoded image parts keyed by content hash; a part is only read while a
+# message is generated, so one cached part can go into any number of messages
+IMAGE_PART_CACHE = LRUCache(IMAGE_PART_CACHE_ENTRIES, IMAGE_PART_CACHE_BYTES)
+_generator_buffers = threading.local()
+
+
+class PartCachingGenerator(BytesGenerator):
+    # Parts carrying pre-rendered bytes (see build_image_part) are copied
+    # through verbatim instead of being re-serialized line by line
+    def _write(self, msg):
+        rendered = getattr(msg, 'rendered', None)
+        if rendered is None:
+            super()._write(msg)
+        else:
+            self._fp.write(rendered)
+
+
+def render_part(part):
+    buffer = io.BytesIO()
+    BytesGenerator(buffer, mangle_from_=False, policy=SMTP_POLICY).flatten(part)
+    return buffer.getvalue()
+
+
+# Image processing - optional, needs Pillow and an image_max_dimension in smtp_config.json
+IMAGE_WORKERS = 2
+IMAGE_PROCESS_TIMEOUT = 60
+IMAGE_CACHE_ENTRIES = 256
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+
+def image_settings(config):
+    max_dimension = int(config.get('image_max_dimension') or 0)
+    if not max_dimension or Image is None:
+        return None
+    return (max_dimension, int(config.get('image_quality', 85)), str(config.get('image_format', 'JPEG')).upper())
+
+
+def shrink_image(data, max_dimension, quality, image_format):
+    """Downscale, drop EXIF and re-encode; runs in a worker process.
+
+    Returns (data, extension), or (data, None) when the original is kept.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if getattr(img, 'is_animated', False):
+            return data, None
+        source_format = img.format
+        has_exif = 'exif' in img.info
+        fits = max(img.size) <= max_dimension
+        target = source_format if image_format == 'KEEP' else image_format
+        if target not in IMAGE_EXTENSIONS:
+            target = 'JPEG'
+        if fits and not has_exif and target == source_format:
+            return data, None
+        # Apply the EXIF orientation to the pixels before the EXIF goes away
+        shrunk = ImageOps.exif_transpose(img)
+        shrunk.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if target == 'JPEG' and shrunk.mode not in ('RGB', 'L'):
+            shrunk = shrunk.convert('RGB')
+        out = io.BytesIO()
+        shrunk.save(out, target, quality=quality, optimize=True)
+    if fits and not has_exif and out.tell() >= len(data):
+        return data, None
+    return out.getvalue(), IMAGE_EXTENSIONS[target]
+
+
+class ImageProcessor:
+    """Runs shrink_image in a process pool, so CPU-heavy resizing doesn't hold
+    the GIL against request handling, and caches results by content hash."""
+
+    def __init__(self, workers=IMAGE_WORKERS):
+        self.workers = workers
+        self.cache = LRUCache(IMAGE_CACHE_ENTRIES, IMAGE_CACHE_BYTES)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: this process is multi-threaded
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def process(self, data, filename, settings, digest):
+        key = (digest, settings)
+        cached = self.cache.get(key)
+        if cached is None:
+            try:
+                future = self._pool().submit(shrink_image, data, *settings)
+                cached = future.result(timeout=IMAGE_PROCESS_TIMEOUT)
+            except Exception as e:
+                print(f"Image processing failed, attaching {filename} unchanged: {e}")
+                cached = (data, None)
+            self.cache.put(key, cached, len(cached[0]))
+        result, extension = cached
+        if extension:
+            filename = os.path.splitext(filename)[0] + extension
+        return result, filename
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+IMAGE_PROCESSOR = ImageProcessor()
+
+
+def build_image_part(image_data, image_filename, config=None):
+    if isinstance(image_data, UploadedFile):
+        image_data.file.seek(0)
+        image_data = image_data.file.read()
+    digest = hashlib.sha256(image_data).digest()
+    settings = image_settings(config) if config else None
+    key = (digest, image_filename, settings)
+    img = IMAGE_PART_CACHE.get(key)
+    if img is not None:
+        return img
+    if not isinstance(image_data, bytes):
+        image_data = bytes(image_data)
+    if settings:
+        image_data, image_filename = IMAGE_PROCESSOR.process(image_data, image_filename, settings, digest)
+    # The filename decides the subtype when it names an image type; otherwise
+    # MIMEImage sniffs the data
+    content_type = mimetypes.guess_type(image_filename)[0] or ''
+    if content_type.startswith('image/'):
+        img = MIMEImage(image_data, content_type.split('/', 1)[1], policy=SMTP_POLICY)
+    else:
+        img = MIMEImage(image_data, policy=SMTP_POLICY)
+    img.add_header('Content-ID', '<image1>')
+    img.add_header('Content-Disposition', 'inline', filename=image_filename)
+    img.rendered = render_part(img)
+    IMAGE_PART_CACHE.put(key, img, len(img.get_payload()) + len(img.rendered))
+    return img
+
+
+def message_bytes(msg):
+    # Generate straight to CRLF bytes, which sendmail() passes through as-is;
+    # as_string() would go str -> EOL-fixed str -> bytes. Each thread reuses
+    # one buffer so large messages don't regrow it from scratch every time.
+    buffer = getattr(_generator_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _generator_buffers.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    PartCachingGenerator(buffer, mangle_from_=False, policy=SMTP_POLICY).flatten(msg)
+    data = buffer.getvalue()
+    if buffer.tell() > MESSAGE_BUFFER_KEEP:
+        del _generator_buffers.buffer
+    return data
+
+
+def render_email_html(subject, message, has_image):
+    # Create HTML message with image AT THE TOP
+    html_message = f"""
+    <html>
+        <body>
+            <div style="font-family: Arial, sans-serif; max-width: 100%;">
+                <div style="background: #f8f9fa; padding: 15px; border-radius: 8px;">
+                    <h2 style="color: #333; margin: 0 0 15px 0;">{subject}</h2>
+    """
+    
+    # IMAGE AT THE TOP - before the message
+    if has_image:
+        html_message += f"""
+                    <div style="margin-bottom: 15px; text-align: center;">
+                        <img src="cid:image1" style="max-width: 100%; max-height: 400px; border-radius: 6px; border: 1px solid #ddd;">
+                    </div>
+        """
+    
+    # MESSAGE BELOW THE IMAGE
+    html_message += f"""
+                    <div style="white-space: pre-line; line-height: 1.5; color: #555; padding: 10px 0;">
+                        {message}
+                    </div>
+                </div>
+            </div>
+        </body>
+    </html>
+    """
+    return html_message
+
+
+def build_html_part(subject, message, has_image):
+    return MIMEText(render_email_html(subject, message, has_image), 'html', policy=SMTP_POLICY)
+
+
+def build_message(config, recipient, subject, sender_name, html_part, image_part=None):
+    # html_part and image_part are only read while generating, so one encoded
+    # part can be shared by many messages. Everything uses SMTP_POLICY so the
+    # generator's temporary policy swap on shared parts is a no-op.
+    msg = MIMEMultipart(policy=SMTP_POLICY)
+    msg['From'] = f'{sender_name} <{config["your_email"]}>'
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    if image_part is not None:
+        msg.attach(image_part)
+    # ONLY attach HTML version to avoid duplicates
+    msg.attach(html_part)
+    return msg
+
+
+def deliver_email(config, recipient, subject, message, sender_name, image_data, image_filename):
+    with METRICS.stage('mime_build'):
+        image_part = None
+        if image_data and image_filename:
+            # Attach straight from memory - no temp file, no shared upload path
+            image_part = build_image_part(image_data, image_filename, config)
+        html_part = build_html_part(subject, message, image_part is not None)
+
+    def build(relay):
+        # The From address is the relay's own account
+        with METRICS.stage('mime_build'):
+            return message_bytes(build_message(relay, recipient, subject, sender_name, html_part, image_part))
+    RELAYS.send(config, recipient, build)
+
+
+# Rate limiting - "rate_limits" in smtp_config.json, e.g.
+#   {"account": {"per_minute": 60, "burst": 10}, "user": {"per_minute": 20},
+#    "domain": {"per_minute": 30}, "domains": {"gmail.com": {"per_minute": 10}}}
+RATE_LIMIT_MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+def rate_limit_keys(username, recipient):
+    # The account bucket is taken by RELAYS once it knows which relay sends
+    return (('user', username), ('domain', recipient.rpartition('@')[2].lower()))
+
+
+class RateLimiter:
+    """Token buckets per sending account, logged-in user and recipient domain.
+
+    reserve() always takes a token from every bucket that applies, letting a
+    bucket go into debt; the deepest debt is how long the caller must hold the
+    send. Sends therefore leave at the configured rate in the order they
+    reserved, instead of all retrying the moment a token frees up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limits = None
+        self._buckets = {}
+        # Fraction of each configured rate this process may use (1/N with N worker processes)
+        self.share = 1.0
+
+    def configure(self, limits):
+        if limits is self._limits:
+            return
+        with self._lock:
+            self._limits = limits
+            # Buckets whose settings changed start over on their next use
+            self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                             if self._setting(*key) == (bucket.rate, bucket.burst)}
+
+    def _setting(self, kind, name):
+        limits = self._limits or {}
+        spec = limits.get(kind)
+        if kind == 'domain':
+            spec = (limits.get('domains') or {}).get(name, spec)
+        if not spec or not spec.get('per_minute'):
+            return None
+        return spec['per_minute'] / 60.0 * self.share, max(1, int(spec.get('burst', 1) * self.share))
+
+    def reserve(self, keys):
+        """Take a token for one send; returns (seconds to wait, kind of the limiting bucket)."""
+        if not self._limits:
+            return 0.0, None
+        now = time.monotonic()
+        wait, limited_by = 0.0, None
+        with self._lock:
+            for kind, name in keys:
+                setting = name and self._setting(kind, name)
+                if not setting:
+                    continue
+                bucket = self._buckets.get((kind, name))
+                if bucket is None:
+                    if len(self._buckets) >= RATE_LIMIT_MAX_BUCKETS:
+                        self._prune(now)
+                    bucket = self._buckets[(kind, name)] = TokenBucket(*setting)
+                bucket.refill(now)
+                bucket.tokens -= 1
+                if bucket.tokens < 0 and -bucket.tokens / bucket.rate > wait:
+                    wait, limited_by = -bucket.tokens / bucket.rate, kind
+        if wait:
+            METRICS.inc('smtp_river_throttled_total', bucket=limited_by)
+            METRICS.observe('smtp_river_throttle_wait_seconds', wait)
+        return wait, limited_by
+
+    def delay(self, kind, name):
+        """Seconds until a bucket has a token free, without taking it."""
+        setting = self._limits and self._setting(kind, name)
+        if not setting:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get((kind, name))
+            if bucket is None:
+                return 0.0
+            bucket.refill(time.monotonic())
+            return max(0.0, (1 - bucket.tokens) / bucket.rate)
+
+    def _prune(self, now):
+        # A bucket that has refilled completely is the same as a new one
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+
+RATE_LIMITER = RateLimiter()
+
+
+# Recipient validation - syntax always; MX/A lookups with "check_mx": true in smtp_config.json
+DOMAIN_CACHE_ENTRIES = 10000
+DOMAIN_CACHE_TTL = 3600          # seconds a domain that accepts mail is remembered
+DOMAIN_NEGATIVE_TTL = 300        # seconds a domain that doesn't is remembered
+DNS_TIMEOUT = 3
+LOCAL_PART_PATTERN = re.compile(
+    r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"   # dot-atom
+    r'|"([\x20\x21\x23-\x5b\x5d-\x7e]|\\[\x20-\x7e])*"')              # quoted-string
+DOMAIN_LABEL_PATTERN = re.compile(r'[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?')
+
+
+class InvalidRecipient(ValueError):
+    pass
+
+
+def normalize_address(address):
+    """Check an addr-spec against RFC 5322 and return it with the domain lowercased and IDNA-encoded."""
+    address = address.strip()
+    local, at, domain = address.rpartition('@')
+    if not at or not local or not domain:
+        raise InvalidRecipient(f"{address!r} is not an email address")
+    if len(local) > 64 or not LOCAL_PART_PATTERN.fullmatch(local):
+        raise InvalidRecipient(f"{address!r} has an invalid local part")
+    try:
+        domain = domain.rstrip('.').encode('idna').decode('ascii').lower()
+    except UnicodeError:
+        raise InvalidRecipient(f"{address!r} has an invalid domain") from None
+    labels = domain.split('.')
+    if len(labels) < 2 or len(domain) > 253 or not all(DOMAIN_LABEL_PATTERN.fullmatch(label) for label in labels):
+        raise InvalidRecipient(f"{address!r} has an invalid domain")
+    address = f'{local}@{domain}'
+    if len(address) > 254:
+        raise InvalidRecipient(f"{address!r} is too long")
+    return address
+
+
+def resolve_domain(domain):
+    """True if the domain can receive mail (an MX, or an address record as the
+    implicit MX), False if it can't, LookupError if the answer is unknown."""
+    if dns is None:
+        try:
+            socket.getaddrinfo(domain, 25, proto=socket.IPPROTO_TCP)
+            return True
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)):
+                return False
+            raise LookupError(str(e)) from None
+    try:
+        answer = dns.resolver.resolve(domain, 'MX', lifetime=DNS_TIMEOUT)
+        # A lone "MX 0 ." is the RFC 7505 way of saying the domain takes no mail
+        return not (len(answer) == 1 and answer[0].exchange.to_text() == '.')
+    except dns.resolver.NXDOMAIN:
+        return False
+    except dns.resolver.NoAnswer:
+        pass
+    except dns.exception.DNSException as e:
+        raise LookupError(str(e)) from None
+    for record_type in ('A', 'AAAA'):
+        try:
+            dns.resolver.resolve(domain, record_type, lifetime=DNS_TIMEOUT)
+            return True
+        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+            continue
+        except dns.exception.DNSException as e:
+            raise LookupError(str(e)) from None
+    return False
+
+
+class DomainChecker:
+    """Remembers which recipient domains accept mail, good answers for an hour
+    and bad ones for five minutes. Unknown answers (timeouts, SERVFAIL) let the
+    address through and aren't cached."""
+
+    def __init__(self, resolver=resolve_domain, max_entries=DOMAIN_CACHE_ENTRIES):
+        self.resolver = resolver
+        self.cache = LRUCache(max_entries)
+
+    def set_resolver(self, resolver):
+        self.resolver = resolver
+        self.cache = LRUCache(self.cache.max_entries)
+
+    def accepts_mail(self, domain):
+        cached = self.cache.get(domain)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        try:
+            accepts = bool(self.resolver(domain))
+        except LookupError:
+            return True
+        self.cache.put(domain, (accepts, time.monotonic() + (DOMAIN_CACHE_TTL if accepts else DOMAIN_NEGATIVE_TTL)))
+        return accepts
+
+
+DOMAIN_CHECKER = DomainChecker()
+
+
+def validate_recipient(address, config):
+    """The normalized address, or InvalidRecipient before it costs an SMTP session."""
+    try:
+        address = normalize_address(address)
+        if config.get('check_mx') and not DOMAIN_CHECKER.accepts_mail(address.rpartition('@')[2]):
+            raise InvalidRecipient(f"{address.rpartition('@')[2]} does not accept mail")
+    except InvalidRecipient:
+        METRICS.inc('smtp_river_recipients_rejected_total')
+        raise
+    return address
+
+
+# Multipart uploads
+MULTIPART_CHUNK_SIZE = 64 * 1024
+MULTIPART_MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 256 * 1024            # any single text field
+MAX_UPLOAD_SIZE = 25 * 1024 * 1024     # any single file part
+MAX_REQUEST_SIZE = 30 * 1024 * 1024    # whole request body
+# A JSON message carries its attachment as base64, a third larger than the file itself
+MAX_JSON_SIZE = (MAX_UPLOAD_SIZE + 2) // 3 * 4 + MAX_REQUEST_SIZE - MAX_UPLOAD_SIZE
+SPOOL_THRESHOLD = 1024 * 1024          # file parts larger than this spill to a temp file
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+def multipart_boundary(content_type):
+    return content_type.split('boundary=')[1].split(';')[0].strip().strip('"').encode()
+
+
+class UploadedFile:
+    def __init__(self, filename, content_type):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.file.write(data)
+
+    def chunks(self, chunk_size=MULTIPART_CHUNK_SIZE):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartParser:
+    """Reads multipart/form-data from a socket file in fixed-size chunks.
+
+    Text fields are collected in memory up to max_field_size; file parts are
+    written to an UploadedFile as they arrive, so memory stays bounded by the
+    chunk size however large the upload is.
+    """
+
+    def __init__(self, rfile, boundary, content_length, chunk_size=MULTIPART_CHUNK_SIZE,
+                 max_field_size=MAX_FIELD_SIZE, max_file_size=MAX_UPLOAD_SIZE):
+        self.rfile = rfile
+        self.delimiter = b'\r\n--' + boundary
+        self.remaining = content_length
+        self.chunk_size = chunk_size
+        self.max_field_size = max_field_size
+        self.max_file_size = max_file_size
+        # Leading CRLF lets the first boundary match the same delimiter as the rest
+        self.buffer = bytearray(b'\r\n')
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        chunk = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not chunk:
+            raise ValueError("Incomplete multipart body")
+        self.remaining -= len(chunk)
+        self.buffer += chunk
+        return True
+
+    def _find(self, marker, limit):
+        start = 0
+        while True:
+            index = self.buffer.find(marker, start)
+            if index >= 0:
+                return index
+            if len(self.buffer) > limit:
+                raise RequestTooLarge("Multipart headers too large")
+            start = max(0, len(self.buffer) - len(marker) + 1)
+            if not self._fill():
+                raise ValueError("Malformed multipart body")
+
+    def _read_part(self, sink, limit, name):
+        # Everything up to the next delimiter belongs to this part; the last
+        # len(delimiter) - 1 bytes are held back in case a delimiter straddles chunks
+        keep = len(self.delimiter) - 1
+        size = 0
+        while True:
+            index = self.buffer.find(self.delimiter)
+            end = index if index >= 0 else max(0, len(self.buffer) - keep)
+            if end:
+                size += end
+                if size > limit:
+                    raise RequestTooLarge(f"Field '{name}' exceeds {limit} bytes")
+                with memoryview(self.buffer) as view:
+                    sink.write(view[:end])
+                del self.buffer[:end]
+            if index >= 0:
+                del self.buffer[:len(self.delimiter)]
+                return
+            if not self._fill():
+                raise ValueError("Incomplete multipart body")
+
+    def parse(self):
+        fields = {}
+        files = {}
+        try:
+            index = self._find(self.delimiter, MULTIPART_MAX_HEADER_SIZE)
+            del self.buffer[:index + len(self.delimiter)]
+            while True:
+                while len(self.buffer) < 2:
+                    if not self._fill():
+                        raise ValueError("Incomplete multipart body")
+                if self.buffer[:2] == b'--':
+                    break
+                index = self._find(b'\r\n\r\n', MULTIPART_MAX_HEADER_SIZE)
+                headers = HeaderParser().parsestr(bytes(self.buffer[2:index]).decode('utf-8', 'replace'))
+                del self.buffer[:index + 4]
+                name = headers.get_param('name', header='content-disposition') or ''
+                filename = headers.get_param('filename', header='content-disposition')
+                if filename is None:
+                    field = io.BytesIO()
+                    self._read_part(field, self.max_field_size, name)
+                    fields[name] = field.getvalue().decode('utf-8')
+                else:
+                    if name in files:
+                        files[name].close()
+                    files[name] = UploadedFile(filename, headers.get_content_type())
+                    self._read_part(files[name], self.max_file_size, name)
+            # Drain the epilogue so a keep-alive connection stays in sync
+            while self._fill():
+                self.buffer.clear()
+        except Exception:
+            for upload in files.values():
+                upload.close()
+            raise
+        return fields, files
+
+
+# Deduplication - a message repeated within "dedup_window" seconds (0 turns it off)
+# coalesces into the job already queued for it
+DEDUP_WINDOW = 600
+DEDUP_MAX_ENTRIES = 100000       # keys held in memory; older ones are only caught by emails.db
+DEDUP_PRUNE_INTERVAL = 60        # seconds between deletes of expired message_keys rows
+IDEMPOTENCY_KEY_MAX = 200
+
+
+class DuplicateMessage(Exception):
+    def __init__(self, job_id):
+        super().__init__(f"Already queued as job #{job_id}")
+        self.job_id = job_id
+
+
+def attachment_digest(image_data):
+    if not image_data:
+        return ''
+    digest = hashlib.sha256()
+    if isinstance(image_data, UploadedFile):
+        for chunk in image_data.chunks():
+            digest.update(chunk)
+    else:
+        digest.update(image_data)
+    return digest.hexdigest()
+
+
+def message_key(recipient, subject, message, sender_name, image_data, idempotency_key=None, username=None,
+                send_at=None):
+    """A client-supplied idempotency key scoped to its user, else a hash of the content and send time."""
+    if idempotency_key:
+        if len(idempotency_key) > IDEMPOTENCY_KEY_MAX:
+            raise ValueError(f"Idempotency key exceeds {IDEMPOTENCY_KEY_MAX} characters")
+        parts = ('key', username or '', idempotency_key)
+    else:
+        parts = ('content', recipient.lower(), subject, message, sender_name, attachment_digest(image_data),
+                 '' if send_at is None else f'{send_at:.0f}')
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def job_failed(job_id):
+    row = get_db().execute('SELECT status FROM delivery_queue WHERE id = ?', (job_id,)).fetchone()
+    return row is not None and row['status'] == 'failed'
+
+
+class DedupIndex:
+    """Keys of recently queued messages, oldest first, mapped to their job.
+
+    A new message is checked in memory only; a repeat costs one lookup to make
+    sure its job hasn't failed, since a failed message may be sent again. Each
+    key is written to message_keys in the same transaction as its job, which
+    is what the index is reloaded from on startup and what catches a repeat
+    that reaches another process first.
+    """
+
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key -> [job_id, created]; job_id is None while the first copy is being queued
+        self._entries = OrderedDict()
+        self._changed = threading.Condition()
+        self._next_prune = 0.0
+
+    def init_db(self):
+        db = get_db()
+        db.execute('''CREATE TABLE IF NOT EXISTS message_keys
+                 (key TEXT PRIMARY KEY,
+                  job_id INTEGER NOT NULL,
+                  created REAL NOT NULL) WITHOUT ROWID''')
+        db.commit()
+
+    def load(self, window=DEDUP_WINDOW):
+        self.init_db()
+        self.prune(window)
+        db = get_db()
+        rows = db.execute('SELECT key, job_id, created FROM message_keys ORDER BY created DESC LIMIT ?',
+                          (self.max_entries,)).fetchall()
+        with self._changed:
+            self._entries.clear()
+            for row in reversed(rows):
+                self._entries[row['key']] = [row['job_id'], row['created']]
+
+    def prune(self, window):
+        """Delete expired keys from message_keys, at most every DEDUP_PRUNE_INTERVAL."""
+        now = time.time()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + DEDUP_PRUNE_INTERVAL
+        db = get_db()
+        db.execute('DELETE FROM message_keys WHERE created <= ?', (now - window,))
+        db.commit()
+
+    def _expire(self, cutoff):
+        entries = self._entries
+        while entries:
+            created = next(iter(entries.values()))[1]
+            if created > cutoff and len(entries) <= self.max_entries:
+                return
+            entries.popitem(last=False)
+
+    def submit(self, key, window, enqueue):
+        """Return (job_id, duplicate): the job already queued under key, or the
+        one enqueue(key) creates."""
+        while True:
+            with self._changed:
+                now = time.time()
+                self._expire(now - window)
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = [None, now]
+                    break
+                # A concurrent copy is still being queued; its outcome decides this one
+                while entry[0] is None and self._entries.get(key) is entry:
+                    self._changed.wait()
+                job_id = entry[0]
+            if job_id is None:
+                continue
+            # Only repeats pay for this lookup; a resend after a permanent failure is queued anew
+            if not job_failed(job_id):
+                METRICS.inc('smtp_river_duplicates_total', source='memory')
+                return job_id, True
+            with self._changed:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+        try:
+            job_id = enqueue(key)
+        except DuplicateMessage as e:
+            METRICS.inc('smtp_river_duplicates_total', source='database')
+            job_id, duplicate = e.job_id, True
+        except BaseException:
+            with self._changed:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                self._changed.notify_all()
+            raise
+        else:
+            duplicate = False
+        with self._changed:
+            entry[0] = job_id
+            self._changed.notify_all()
+        return job_id, duplicate
+
+    def __len__(self):
+        return len(self._entries)
+
+
+DEDUP = DedupIndex()
+
+
+# Delivery queue
+DB_FILE = "emails.db"
+QUEUE_WORKERS = 4                # concurrent SMTP deliveries
+QUEUE_MAX_ATTEMPTS = 5
+QUEUE_RETRY_BASE = 30            # seconds before the first retry, doubled per attempt
+QUEUE_POLL_INTERVAL = 5          # longest a worker sleeps without being woken
+
+_db_local = threading.local()
+
+
+def get_db():
+    # One SQLite connection per thread; WAL lets readers and the writer overlap
+    db = getattr(_db_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(DB_FILE, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        _db_local.db = db
+    return db
+
+
+def close_db():
+    # A connection must not be carried across fork(); the pre-fork supervisor drops its own first
+    db = getattr(_db_local, 'db', None)
+    if db is not None:
+        db.close()
+        _db_local.db = None
+
+
+def is_transient_error(e):
+    if isinstance(e, NoRelayAvailable):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (smtplib.SMTPServerDisconnected, TimeoutError, ConnectionError))
+
+
+class DeliveryQueue:
+    """Messages persisted in emails.db and delivered by a bounded pool of worker threads."""
+
+    def __init__(self, workers=QUEUE_WORKERS):
+        self.workers = workers
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._running = False
+
+    def init_db(self):
+        db = get_db()
+        db.executescript('''CREATE TABLE IF NOT EXISTS delivery_queue
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  sender_name TEXT,
+                  recipient TEXT,
+                  subject TEXT,
+                  message TEXT,
+                  image BLOB,
+                  image_filename TEXT,
+                  status TEXT NOT NULL DEFAULT 'queued',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt REAL NOT NULL,
+                  last_error TEXT,
+                  created REAL NOT NULL,
+                  updated REAL NOT NULL,
+                  username TEXT,
+                  claimed_by INTEGER,
+                  throttled_until REAL);
+                  CREATE INDEX IF NOT EXISTS idx_delivery_queue_due
+                  ON delivery_queue (status, next_attempt);''')
+        columns = {row['name'] for row in db.execute('PRAGMA table_info(delivery_queue)')}
+        for column in ('username TEXT', 'claimed_by INTEGER', 'throttled_until REAL'):
+            if column.split()[0] not in columns:
+                db.execute(f'ALTER TABLE delivery_queue ADD COLUMN {column}')
+        db.commit()
+
+    def requeue_claimed(self, pid=None):
+        """Put back jobs that were being sent by a process that has exited (any process if pid is None)."""
+        db = get_db()
+        if pid is None:
+            cur = db.execute("UPDATE delivery_queue SET status = 'queued' WHERE status = 'sending'")
+        else:
+            cur = db.execute("UPDATE delivery_queue SET status = 'queued' WHERE status = 'sending' AND claimed_by = ?",
+                             (pid,))
+        db.commit()
+        return cur.rowcount
+
+    def enqueue(self, recipient, subject, message, sender_name, image_data, image_filename, username=None,
+                key=None, window=DEDUP_WINDOW, send_at=None):
+        """Queue a message, or schedule it when send_at (Unix seconds) is given."""
+        now = time.time()
+        db = get_db()
+        cur = db.execute('''INSERT INTO delivery_queue
+                 (sender_name, recipient, subject, message, image, image_filename, status, next_attempt, created,
+                  updated, username)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                 (sender_name, recipient, subject, message,
+                  None if isinstance(image_data, UploadedFile) else image_data, image_filename,
+                  'queued' if send_at is None else 'scheduled', send_at or now, now, now, username))
+        if key is not None:
+            # An expired key, or one whose job failed, is taken over; a live one means another
+            # process queued this message
+            claimed = db.execute('''INSERT INTO message_keys (key, job_id, created) VALUES (?, ?, ?)
+                     ON CONFLICT (key) DO UPDATE SET job_id = excluded.job_id, created = excluded.created
+                     WHERE message_keys.created <= ? OR EXISTS (SELECT 1 FROM delivery_queue
+                           WHERE id = message_keys.job_id AND status = 'failed')''',
+                     (key, cur.lastrowid, now, now - window)).rowcount
+            if not claimed:
+                db.rollback()
+                row = db.execute('SELECT job_id FROM message_keys WHERE key = ?', (key,)).fetchone()
+                raise DuplicateMessage(row['job_id'])
+        if isinstance(image_data, UploadedFile):
+            self._store_upload(db, cur.lastrowid, image_data)
+        db.commit()
+        if send_at is None:
+            with self._wakeup:
+                self._wakeup.notify()
+        else:
+            SCHEDULER.scheduled(send_at)
+        return cur.lastrowid
+
+    def wake(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _store_upload(self, db, job_id, upload):
+        if not hasattr(db, 'blobopen'):
+            upload.file.seek(0)
+            db.execute('UPDATE delivery_queue SET image = ? WHERE id = ?', (upload.file.read(), job_id))
+            return
+        # Stream the spooled upload into the row instead of materialising it
+        db.execute('UPDATE delivery_queue SET image = zeroblob(?) WHERE id = ?', (upload.size, job_id))
+        with db.blobopen('delivery_queue', 'image', job_id) as blob:
+            for chunk in upload.chunks():
+                blob.write(chunk)
+
+    def status(self, job_id, username):
+        # Only the user who queued a job can see it; anyone else gets the same answer as for no job
+        row = get_db().execute('''SELECT id, recipient, subject, status, attempts, next_attempt, last_error, created, updated
+                 FROM delivery_queue WHERE id = ? AND username = ?''', (job_id, username)).fetchone()
+        return dict(row) if row else None
+
+    def stats(self):
+        rows = get_db().execute('SELECT status, COUNT(*) FROM delivery_queue GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def due(self):
+        # Queued jobs whose time has come: the backlog the workers haven't reached
+        return get_db().execute("SELECT COUNT(*) FROM delivery_queue WHERE status = 'queued' AND next_attempt <= ?",
+                                (time.time(),)).fetchone()[0]
+
+    def start(self, recover=True):
+        self.init_db()
+        if recover:
+            # Jobs a worker had claimed when the process died go back on the queue
+            self.requeue_claimed()
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'delivery-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop claiming jobs; deliveries in progress carry on."""
+        self._running = False
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def join(self, timeout=None):
+        """Wait up to timeout for the workers to finish; returns how many were still delivering."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        running = sum(thread.is_alive() for thread in self._threads)
+        self._threads = []
+        return running
+
+    def _claim(self):
+        db = get_db()
+        while True:
+            now = time.time()
+            row = db.execute('''SELECT * FROM delivery_queue
+                     WHERE status = 'queued' AND next_attempt <= ?
+                     ORDER BY next_attempt LIMIT 1''', (now,)).fetchone()
+            if row is None:
+                return None
+            cur = db.execute('''UPDATE delivery_queue SET status = 'sending', updated = ?, claimed_by = ?
+                     WHERE status = 'queued' AND id = ?''', (now, os.getpid(), row['id']))
+            db.commit()
+            if cur.rowcount:
+                return row
+
+    def _wait(self):
+        due = get_db().execute("SELECT MIN(next_attempt) FROM delivery_queue WHERE status = 'queued'").fetchone()[0]
+        timeout = QUEUE_POLL_INTERVAL if due is None else min(max(due - time.time(), 0), QUEUE_POLL_INTERVAL)
+        with self._wakeup:
+            if self._running:
+                self._wakeup.wait(timeout)
+
+    def _work(self):
+        while self._running:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._wait()
+                    continue
+                if not self._throttle(job):
+                    self._deliver(job)
+            except Exception as e:
+                print(f"Delivery worker error: {e}")
+                time.sleep(1)
+
+    def _throttle(self, job):
+        """Reserve the job's send slot; if it isn't now, put the job back until then."""
+        db = get_db()
+        if job['throttled_until'] is not None:
+            # Put back by the rate limiter, so it already holds a send slot - whichever process claims it
+            db.execute('UPDATE delivery_queue SET throttled_until = NULL WHERE id = ?', (job['id'],))
+            db.commit()
+            return False
+        config = load_config()
+        RATE_LIMITER.configure(config.get('rate_limits'))
+        wait, _ = RATE_LIMITER.reserve(rate_limit_keys(job['username'], job['recipient']))
+        if not wait:
+            return False
+        now = time.time()
+        db.execute('''UPDATE delivery_queue SET status = 'queued', next_attempt = ?, throttled_until = ?, updated = ?
+                 WHERE id = ?''', (now + wait, now + wait, now, job['id']))
+        db.commit()
+        return True
+
+    def _deliver(self, job):
+        db = get_db()
+        attempts = job['attempts'] + 1
+        METRICS.inc('smtp_river_sends_in_flight')
+        METRICS.trace_begin()
+        start = time.perf_counter()
+        try:
+            config = load_config()
+            deliver_email(config, job['recipient'], job['subject'], job['message'], job['sender_name'],
+                          job['image'], job['image_filename'])
+        except NoRelayAvailable as e:
+            if e.login_rejected:
+                # A wrong password won't fix itself: this counts as an attempt, so the job fails in the end
+                self._failed(job, attempts, e, "Auth failed - check password", e.retry_at)
+            else:
+                # Waiting out a relay's cooldown or quota isn't a failed attempt
+                METRICS.inc('smtp_river_sends_total', outcome='deferred')
+                db.execute('''UPDATE delivery_queue SET status = 'queued', next_attempt = ?, last_error = ?,
+                         updated = ? WHERE id = ?''', (e.retry_at, str(e), time.time(), job['id']))
+        except Exception as e:
+            self._failed(job, attempts, e,
+                         "Auth failed - check password" if isinstance(e, smtplib.SMTPAuthenticationError) else str(e))
+        else:
+            METRICS.inc('smtp_river_sends_total', outcome='sent')
+            HISTORY.record(job['sender_name'], job['recipient'], job['subject'], job['message'],
+                           job['image'] and job['image_filename'])
+            db.execute('''UPDATE delivery_queue SET status = 'sent', attempts = ?, image = NULL,
+                     last_error = NULL, updated = ? WHERE id = ?''',
+                     (attempts, time.time(), job['id']))
+        finally:
+            METRICS.inc('smtp_river_sends_in_flight', -1)
+            METRICS.trace_end(f"job #{job['id']}", time.perf_counter() - start)
+        db.commit()
+
+    def _failed(self, job, attempts, e, error, not_before=0):
+        """Retry a failed attempt with backoff (not before not_before), or fail the job for good."""
+        db = get_db()
+        retry = is_transient_error(e) and attempts < QUEUE_MAX_ATTEMPTS
+        METRICS.inc('smtp_river_sends_total', outcome='retry' if retry else send_outcome(e))
+        if retry:
+            next_attempt = max(time.time() + QUEUE_RETRY_BASE * 2 ** (attempts - 1), not_before)
+            db.execute('''UPDATE delivery_queue SET status = 'queued', attempts = ?, next_attempt = ?,
+                     last_error = ?, updated = ? WHERE id = ?''',
+                     (attempts, next_attempt, error, time.time(), job['id']))
+        else:
+            db.execute('''UPDATE delivery_queue SET status = 'failed', attempts = ?, image = NULL,
+                     last_error = ?, updated = ? WHERE id = ?''',
+                     (attempts, error, time.time(), job['id']))
+
+
+DELIVERY_QUEUE = DeliveryQueue()
+
+
+# Scheduled sends - jobs with a send_at wait in delivery_queue with status 'scheduled'
+SCHEDULE_MAX_AHEAD = 366 * 86400 # furthest ahead a send can be scheduled, in seconds
+SCHEDULE_MAX_SLEEP = 300         # longest the dispatcher sleeps without re-reading the next due time
+SCHEDULE_RELEASE_BATCH = 1000    # due jobs moved to the queue per transaction
+
+
+def send_time(send_at=None, delay=None, tz_offset=None):
+    """When to send, as Unix seconds, or None for now.
+
+    send_at is an ISO 8601 time or Unix seconds; delay is seconds from now. A
+    send_at without a UTC offset is in the client's zone when tz_offset (minutes
+    behind UTC, as from JavaScript's getTimezoneOffset()) is given, otherwise in
+    the server's.
+    """
+    for value in (send_at, delay, tz_offset):
+        # JSON can carry anything; only strings and numbers are times
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+            raise ValueError(f"Invalid send time {value!r}; use a string or a number")
+    now = time.time()
+    try:
+        if delay not in (None, ''):
+            when = now + float(delay)
+        elif send_at in (None, ''):
+            return None
+        elif isinstance(send_at, (int, float)) or re.fullmatch(r'\d+(\.\d*)?', str(send_at).strip()):
+            when = float(send_at)
+        else:
+            try:
+                moment = datetime.fromisoformat(str(send_at).strip().replace('Z', '+00:00'))
+            except ValueError:
+                raise ValueError(f"Invalid send_at {send_at!r}; use ISO 8601, e.g. 2030-01-31T09:00:00+01:00")
+            if moment.tzinfo is None and tz_offset not in (None, ''):
+                moment = moment.replace(tzinfo=timezone(timedelta(minutes=-int(tz_offset))))
+            when = moment.timestamp()
+    except OverflowError:
+        # A JSON integer too big for a float
+        raise ValueError("Invalid send time")
+    if not math.isfinite(when):
+        raise ValueError("Invalid send time")
+    if when > now + SCHEDULE_MAX_AHEAD:
+        raise ValueError(f"Sends can be scheduled at most {SCHEDULE_MAX_AHEAD // 86400} days ahead")
+    return when if when > now else None
+
+
+class Scheduler:
+    """Moves scheduled jobs onto the delivery queue as they come due.
+
+    The schedule itself is the (status, next_attempt) index on delivery_queue,
+    so it survives restarts and costs no memory per job: the dispatcher only
+    remembers the earliest due time and sleeps until then, or until an earlier
+    job is scheduled.
+    """
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._wake_at = float('inf')
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        with self._changed:
+            self._changed.notify_all()
+
+    def scheduled(self, when):
+        """Note a newly scheduled job so an earlier one than the dispatcher is waiting for wakes it."""
+        with self._changed:
+            if when < self._wake_at:
+                self._wake_at = when
+                self._changed.notify()
+
+    def _release(self):
+        db = get_db()
+        now = time.time()
+        cur = db.execute('''UPDATE delivery_queue SET status = 'queued', updated = ?
+                 WHERE id IN (SELECT id FROM delivery_queue WHERE status = 'scheduled' AND next_attempt <= ?
+                              ORDER BY next_attempt LIMIT ?)''', (now, now, SCHEDULE_RELEASE_BATCH))
+        db.commit()
+        next_due = db.execute("SELECT MIN(next_attempt) FROM delivery_queue WHERE status = 'scheduled'").fetchone()[0]
+        return cur.rowcount, next_due
+
+    def _run(self):
+        while self._running:
+            with self._changed:
+                # Jobs scheduled from here on lower this again
+                self._wake_at = float('inf')
+            try:
+                # The scheduler wakes at least every SCHEDULE_MAX_SLEEP, so it also clears out old dedup keys
+                DEDUP.prune(load_config().get('dedup_window', DEDUP_WINDOW))
+                released, next_due = self._release()
+            except sqlite3.Error as e:
+                print(f"Scheduler error: {e}")
+                released, next_due = 0, time.time() + 1
+            if released:
+                DELIVERY_QUEUE.wake()
+                if released == SCHEDULE_RELEASE_BATCH:
+                    continue
+            with self._changed:
+                if next_due is not None:
+                    self._wake_at = min(self._wake_at, next_due)
+                # Capped so a changed wall clock is noticed
+                timeout = min(max(self._wake_at - time.time(), 0), SCHEDULE_MAX_SLEEP)
+                if timeout and self._running:
+                    self._changed.wait(timeout)
+
+
+SCHEDULER = Scheduler()
+
+
+# Send history
+HISTORY_BATCH_SIZE = 500
+HISTORY_FLUSH_INTERVAL = 0.5     # longest a recorded send waits before being written
+HISTORY_PAGE_SIZE = 50
+
+
+def fts_query(text):
+    # Quote every term so user input can't trip over FTS5 query syntax
+    return ' '.join('"%s"' % term.replace('"', '""') for term in text.split())
+
+
+class HistoryLog:
+    """Sent messages appended to the sent_emails table in batches.
+
+    Senders only put a row on an in-memory queue; one writer thread commits
+    whatever has accumulated in a single transaction, so logging never holds
+    up delivery.
+    """
+
+    def __init__(self):
+        self._pending = queue.Queue()
+        self._thread = None
+        self.fts = False
+
+    def init_db(self):
+        db = get_db()
+        db.executescript('''CREATE TABLE IF NOT EXISTS sent_emails
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  sender_name TEXT,
+                  recipient TEXT,
+                  subject TEXT,
+                  message TEXT,
+                  has_image INTEGER,
+                  sent_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+                  CREATE INDEX IF NOT EXISTS idx_sent_emails_recipient ON sent_emails (recipient, id);
+                  CREATE INDEX IF NOT EXISTS idx_sent_emails_sent_date ON sent_emails (sent_date);''')
+        try:
+            exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sent_emails_fts'").fetchone()
+            db.executescript('''CREATE VIRTUAL TABLE IF NOT EXISTS sent_emails_fts
+                     USING fts5(subject, message, content='sent_emails', content_rowid='id');
+                     CREATE TRIGGER IF NOT EXISTS sent_emails_fts_insert AFTER INSERT ON sent_emails BEGIN
+                         INSERT INTO sent_emails_fts (rowid, subject, message)
+                         VALUES (new.id, new.subject, new.message);
+                     END;
+                     CREATE TRIGGER IF NOT EXISTS sent_emails_fts_delete AFTER DELETE ON sent_emails BEGIN
+                         INSERT INTO sent_emails_fts (sent_emails_fts, rowid, subject, message)
+                         VALUES ('delete', old.id, old.subject, old.message);
+                     END;
+                     CREATE TRIGGER IF NOT EXISTS sent_emails_fts_update AFTER UPDATE ON sent_emails BEGIN
+                         INSERT INTO sent_emails_fts (sent_emails_fts, rowid, subject, message)
+                         VALUES ('delete', old.id, old.subject, old.message);
+                         INSERT INTO sent_emails_fts (rowid, subject, message)
+                         VALUES (new.id, new.subject, new.message);
+                     END;''')
+            if not exists:
+                db.execute("INSERT INTO sent_emails_fts (sent_emails_fts) VALUES ('rebuild')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5; searches fall back to LIKE
+            self.fts = False
+        db.commit()
+
+    def start(self):
+        self.init_db()
+        self._thread = threading.Thread(target=self._write, name='history', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+        self._pending.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def record(self, sender_name, recipient, subject, message, has_image):
+        self._pending.put((sender_name, recipient, subject, message, int(bool(has_image)),
+                           time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())))
+
+    def _write(self):
+        stopping = False
+        while not stopping:
+            rows = []
+            item = self._pending.get()
+            deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                rows.append(item)
+                if len(rows) >= HISTORY_BATCH_SIZE:
+                    break
+                try:
+                    item = self._pending.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if rows:
+                self._insert(rows)
+
+    def _insert(self, rows):
+        db = get_db()
+        try:
+            with db:
+                db.executemany('''INSERT INTO sent_emails
+                         (sender_name, recipient, subject, message, has_image, sent_date)
+                         VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        except sqlite3.Error as e:
+            print(f"History write failed, {len(rows)} rows lost: {e}")
+
+    def page(self, recipient='', text='', before=None, limit=HISTORY_PAGE_SIZE):
+        """Newest-first page of history; pass the returned cursor as before= for the next page."""
+        join = ''
+        clauses = []
+        params = []
+        if recipient:
+            # Recipients are stored with the domain lowercased; the local part keeps its case
+            local, at, domain = recipient.partition('@')
+            recipient = local + at + domain.lower()
+            # Prefix match as a range so it stays on the recipient index
+            clauses.append('s.recipient >= ? AND s.recipient < ?')
+            params += [recipient, recipient[:-1] + chr(ord(recipient[-1]) + 1)]
+        if text and self.fts:
+            join = 'JOIN sent_emails_fts ON sent_emails_fts.rowid = s.id'
+            clauses.append('sent_emails_fts MATCH ?')
+            params.append(fts_query(text))
+        elif text:
+            clauses.append('(s.subject LIKE ? OR s.message LIKE ?)')
+            params += [f'%{text}%', f'%{text}%']
+        if before is not None:
+            clauses.append('s.id < ?')
+            params.append(before)
+        where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+        rows = get_db().execute(f'''SELECT s.id, s.sent_date, s.sender_name, s.recipient, s.subject, s.has_image
+                 FROM sent_emails s {join} {where} ORDER BY s.id DESC LIMIT ?''', params + [limit + 1]).fetchall()
+        cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+        return rows[:limit], cursor
+
+
+HISTORY = HistoryLog()
+
+
+# Batch sending
+BATCH_SESSIONS = 4               # concurrent SMTP sessions per batch
+ENVELOPE_RECIPIENTS = 1          # recipients per message when the content isn't personalized
+MAX_BATCH_RECIPIENTS = 50000
+FIELD_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+def fill_fields(text, fields, quote=None):
+    def replace(match):
+        value = str(fields.get(match.group(1), ''))
+        return quote(value) if quote else value
+    return FIELD_PATTERN.sub(replace, text)
+
+
+def read_recipients(fileobj, filename=''):
+    """Yield one dict per recipient from a CSV file with a header row, or JSONL.
+
+    The address comes from an 'email' or 'recipient' column and is stored
+    under 'email'; every column is available to templates as {{column}}.
+    """
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    try:
+        if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+            rows = (json.loads(line) for line in text if line.strip())
+        else:
+            rows = csv.DictReader(text)
+        for row in rows:
+            fields = {str(key).strip(): value for key, value in row.items() if key is not None}
+            lowered = {key.lower(): value for key, value in fields.items()}
+            fields['email'] = str(lowered.get('email') or lowered.get('recipient') or '').strip()
+            yield fields
+    finally:
+        text.detach()
+
+
+class BatchSend:
+    """One message template delivered to many recipients over a few pooled SMTP sessions.
+
+    The image part is encoded once, and so is the HTML part when the template
+    has no per-recipient {{fields}}; every message shares them. Identical
+    messages can also share one envelope: with envelope_recipients above 1,
+    up to that many recipients go in a single MAIL/RCPT.../DATA transaction,
+    addressed To: undisclosed-recipients.
+    """
+
+    def __init__(self, config, sender_name, subject, message, image_part=None, sessions=BATCH_SESSIONS,
+                 username=None):
+        self.config = config
+        self.username = username
+        self.sender_name = sender_name
+        self.subject = subject
+        self.message = message
+        self.image_part = image_part
+        self.sessions = sessions
+        self.shared_html = None
+        self.envelope_recipients = 1
+        if not FIELD_PATTERN.search(sender_name + subject + message):
+            self.shared_html = build_html_part(subject, message, image_part is not None)
+            self.envelope_recipients = max(1, int(config.get('envelope_recipients', ENVELOPE_RECIPIENTS)))
+        self._cancelled = False
+        RATE_LIMITER.configure(config.get('rate_limits'))
+
+    def _send(self, rows):
+        """Deliver one envelope, returning a result per row."""
+        results = []
+        recipients = []
+        for row in rows:
+            try:
+                recipients.append(validate_recipient(row['email'], self.config))
+            except InvalidRecipient as e:
+                results.append({'recipient': row['email'], 'status': 'invalid', 'error': str(e)})
+        if not recipients:
+            return results
+        fields = rows[0]
+        with METRICS.stage('mime_build'):
+            subject = fill_fields(self.subject, fields)
+            body = self.message
+            html_part = self.shared_html
+            if html_part is None:
+                # Field values are the CSV's, not the author's: escape them in the HTML, not the Subject header
+                body = fill_fields(self.message, fields, escape)
+                html_part = build_html_part(fill_fields(self.subject, fields, escape), body,
+                                            self.image_part is not None)
+            sender_name = fill_fields(self.sender_name, fields)
+        to = recipients[0] if len(recipients) == 1 else 'undisclosed-recipients:;'
+
+        def build(relay):
+            with METRICS.stage('mime_build'):
+                return message_bytes(build_message(relay, to, subject, sender_name, html_part, self.image_part))
+        wait = max(RATE_LIMITER.reserve(rate_limit_keys(self.username, recipient))[0]
+                   for recipient in recipients)
+        if wait:
+            # Batch workers are the batch's own; holding one back is the backpressure
+            time.sleep(wait)
+        METRICS.inc('smtp_river_sends_in_flight', len(recipients))
+        try:
+            refused = RELAYS.send(self.config, recipients, build)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            METRICS.inc('smtp_river_sends_total', len(recipients), outcome=send_outcome(e))
+            return results + [{'recipient': recipient, 'status': 'failed', 'error': str(e),
+                               'transient': is_transient_error(e)} for recipient in recipients]
+        finally:
+            METRICS.inc('smtp_river_sends_in_flight', -len(recipients))
+        for recipient in recipients:
+            if recipient in refused:
+                code, reply = refused[recipient]
+                METRICS.inc('smtp_river_sends_total', outcome='error')
+                results.append({'recipient': recipient, 'status': 'failed',
+                                'error': f"{code} {reply.decode('utf-8', 'replace')}", 'transient': 400 <= code < 500})
+                continue
+            METRICS.inc('smtp_river_sends_total', outcome='sent')
+            HISTORY.record(sender_name, recipient, subject, body, self.image_part is not None)
+            results.append({'recipient': recipient, 'status': 'sent'})
+        return results
+
+    def run(self, recipients):
+        """Send to every recipient, yielding one result dict per recipient as it completes."""
+        rows = []
+        repeats = []
+        seen = set()
+        for row in recipients:
+            if len(rows) >= MAX_BATCH_RECIPIENTS:
+                raise ValueError(f"Batch exceeds {MAX_BATCH_RECIPIENTS} recipients")
+            # A recipient listed twice would get the same message twice
+            key = row['email'].strip().lower()
+            if self.shared_html is None:
+                key = (key, json.dumps(row, sort_keys=True, default=str))
+            if key in seen:
+                repeats.append(row)
+                continue
+            seen.add(key)
+            rows.append(row)
+        # Recipients of one domain go out back to back
+        rows.sort(key=lambda row: row['email'].rpartition('@')[2].lower())
+        size = self.envelope_recipients
+        envelopes = [rows[i:i + size] for i in range(0, len(rows), size)]
+        pending = iter(envelopes)
+        lock = threading.Lock()
+        results = queue.Queue()
+
+        def work():
+            while not self._cancelled:
+                with lock:
+                    envelope = next(pending, None)
+                if envelope is None:
+                    break
+                for result in self._send(envelope):
+                    results.put(result)
+            results.put(None)
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(min(self.sessions, len(envelopes)))]
+        for worker in workers:
+            worker.start()
+        counts = {'sent': 0, 'failed': 0, 'invalid': 0, 'duplicate': len(repeats)}
+        if repeats:
+            METRICS.inc('smtp_river_duplicates_total', len(repeats), source='batch')
+        try:
+            for row in repeats:
+                yield {'recipient': row['email'], 'status': 'duplicate'}
+            finished = 0
+            while finished < len(workers):
+                result = results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                counts[result['status']] += 1
+                yield result
+        finally:
+            # A client that goes away stops the batch instead of leaving it running
+            self._cancelled = True
+        yield {'summary': counts}
+
+
+# Sessions
+SESSION_COOKIE = 'smtp_river_session'
+SESSION_TTL = 12 * 3600          # seconds a login lasts
+SESSION_CACHE_ENTRIES = 10000
+SESSION_SECRET_FILE = "session_secret"
+SESSION_SECRET_ENV = 'SMTP_RIVER_SECRET'
+SESSION_REVOCATION_SYNC = 1.0    # seconds between checks for logouts made in other processes
+
+
+def session_secret():
+    """The signing key, from the environment or a file created on first use so
+    every process serving this directory shares it."""
+    secret = os.environ.get(SESSION_SECRET_ENV)
+    if secret:
+        return secret.encode('utf-8')
+    try:
+        fd = os.open(SESSION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(SESSION_SECRET_FILE, 'r') as f:
+            return f.read().strip().encode('ascii')
+    secret = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secret)
+    return secret.encode('ascii')
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class SessionStore:
+    """HMAC-signed, expiring session tokens.
+
+    A token is base64(username|expires|id).base64(hmac); checking one needs
+    only the key, so no file or database is read per request. Verified tokens
+    are kept in an LRU cache until they expire, and logging out revokes the
+    token's id until its expiry. Revocations are stored in emails.db once
+    init_db() has run, and picked up from there by other processes at most
+    every SESSION_REVOCATION_SYNC seconds.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_CACHE_ENTRIES):
+        self.ttl = ttl
+        self._secret = None
+        self._lock = threading.Lock()
+        self._cache = LRUCache(max_entries)
+        self._revoked = {}
+        self._last_revocation = 0
+        # None until init_db(): revocations then stay in this process
+        self._next_sync = None
+
+    def init_db(self):
+        db = get_db()
+        db.execute('''CREATE TABLE IF NOT EXISTS revoked_sessions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  session_id TEXT NOT NULL,
+                  expires REAL NOT NULL)''')
+        db.execute('DELETE FROM revoked_sessions WHERE expires <= ?', (time.time(),))
+        db.commit()
+        self._next_sync = 0.0
+
+    def _sync(self, now):
+        with self._lock:
+            if self._next_sync is None or now < self._next_sync:
+                return
+            self._next_sync = now + SESSION_REVOCATION_SYNC
+            rows = get_db().execute('SELECT id, session_id, expires FROM revoked_sessions WHERE id > ?',
+                                    (self._last_revocation,)).fetchall()
+            for row in rows:
+                self._revoked[row['session_id']] = row['expires']
+                self._last_revocation = row['id']
+
+    @property
+    def secret(self):
+        if self._secret is None:
+            with self._lock:
+                if self._secret is None:
+                    self._secret = session_secret()
+        return self._secret
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def create(self, username):
+        expires = int(time.time() + self.ttl)
+        payload = f"{username}|{expires}|{secrets.token_hex(8)}".encode('utf-8')
+        return f"{_b64(payload)}.{_b64(self._sign(payload))}"
+
+    def verify(self, token):
+        """Return the username a token was issued to, or None."""
+        now = time.time()
+        if self._next_sync is not None and now >= self._next_sync:
+            self._sync(now)
+        cached = self._cache.get(token)
+        if cached is not None:
+            username, expires, session_id = cached
+            if now < expires and session_id not in self._revoked:
+                return username
+            self._cache.pop(token)
+            return None
+        try:
+            payload, signature = token.split('.')
+            payload = _unb64(payload)
+            if not hmac.compare_digest(_unb64(signature), self._sign(payload)):
+                return None
+            username, expires, session_id = payload.decode('utf-8').rsplit('|', 2)
+            expires = int(expires)
+        except ValueError:
+            return None
+        if now >= expires or session_id in self._revoked:
+            return None
+        self._cache.put(token, (username, expires, session_id))
+        return username
+
+    def revoke(self, token):
+        self._cache.pop(token)
+        try:
+            payload = _unb64(token.split('.')[0]).decode('utf-8')
+            _, expires, session_id = payload.rsplit('|', 2)
+            expires = int(expires)
+        except ValueError:
+            return
+        now = time.time()
+        with self._lock:
+            for revoked_id, revoked_until in list(self._revoked.items()):
+                if revoked_until <= now:
+                    del self._revoked[revoked_id]
+            self._revoked[session_id] = expires
+            if self._next_sync is None:
+                return
+        db = get_db()
+        db.execute('INSERT INTO revoked_sessions (session_id, expires) VALUES (?, ?)', (session_id, expires))
+        db.commit()
+
+
+SESSIONS = SessionStore()
+
+
+# Pages
+STATIC_CACHE_CONTROL = 'public, max-age=3600'
+
+
+class StaticAsset:
+    def __init__(self, body, content_type):
+        self.body = body.encode('utf-8')
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()[:16]
+
+
+class PageTemplate:
+    """HTML with {{slot}} placeholders, split and encoded once at startup.
+
+    render() encodes only the dynamic values and joins them with the
+    pre-encoded static fragments; with no values it returns cached bytes.
+    """
+
+    def __init__(self, source):
+        pieces = source.split('{{')
+        self.fragments = [pieces[0].encode('utf-8')]
+        self.slots = []
+        for piece in pieces[1:]:
+            slot, text = piece.split('}}', 1)
+            self.slots.append(slot.strip())
+            self.fragments.append(text.encode('utf-8'))
+        self.empty = b''.join(self.fragments)
+
+    def render(self, **values):
+        if not any(values.values()):
+            return self.empty
+        parts = [self.fragments[0]]
+        for slot, fragment in zip(self.slots, self.fragments[1:]):
+            value = values.get(slot)
+            if value:
+                parts.append(value.encode('utf-8'))
+            parts.append(fragment)
+        return b''.join(parts)
+
+
+LOGIN_CSS = """
+* { box-sizing: border-box; margin: 0; padding: 0; }
+body { 
+    font-family: -apple-system, BlinkMacSystemFont, sans-serif;
+    background: #f0f2f5;
+    padding: 20px;
+    min-height: 100vh;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+}
+.login-box {
+    background: white;
+    padding: 30px 25px;
+    border-radius: 12px;
+    box-shadow: 0 4px 12px rgba(0,0,0,0.1);
+    width: 100%;
+    max-width: 400px;
+}
+h2 {
+    text-align: center;
+    color: #1a1a1a;
+    margin-bottom: 25px;
+    font-size: 24px;
+}
+input {
+    width: 100%;
+    padding: 14px;
+    margin: 8px 0;
+    border: 1px solid #ddd;
+    border-radius: 8px;
+    font-size: 16px;
+    background: #fafafa;
+}
+button {
+    width: 100%;
+    background: #007cba;
+    color: white;
+    padding: 16px;
+    border: none;
+    border-radius: 8px;
+    font-size: 17px;
+    font-weight: 600;
+    margin-top: 10px;
+    cursor: pointer;
+}
+.error {
+    color: #d32f2f;
+    background: #ffebee;
+    padding: 12px;
+    border-radius: 6px;
+    margin-bottom: 15px;
+    text-align: center;
+    font-size: 14px;
+}
+.info {
+    text-align: center;
+    margin-top: 20px;
+    color: #666;
+    font-size: 14px;
+}
+"""
+
+MAIN_CSS = """
+* { box-sizing: border-box; margin: 0; padding: 0; }
+body {
+    font-family: -apple-system, BlinkMacSystemFont, sans-serif;
+    background: #f0f2f5;
+    padding: 15px;
+    line-height: 1.4;
+}
+.container {
+    max-width: 100%;
+}
+.header {
+    background: white;
+    padding: 20px;
+    border-radius: 12px;
+    margin-bottom: 15px;
+    box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+}
+.message-form {
+    background: white;
+    padding: 20px;
+    border-radius: 12px;
+    box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+    margin-bottom: 15px;
+}
+input, textarea {
+    width: 100%;
+    padding: 14px;
+    margin: 8px 0;
+    border: 1px solid #ddd;
+    border-radius: 8px;
+    font-size: 16px;
+    background: #fafafa;
+}
+textarea {
+    height: 120px;
+    resize: vertical;
+}
+.field-label {
+    display: block;
+    margin-top: 8px;
+    font-size: 14px;
+    color: #666;
+}
+.send-btn {
+    width: 100%;
+    background: #007cba;
+    color: white;
+    padding: 16px;
+    border: none;
+    border-radius: 8px;
+    font-size: 17px;
+    font-weight: 600;
+    margin-top: 10px;
+    cursor: pointer;
+}
+.send-btn:disabled {
+    background: #ccc;
+    cursor: not-allowed;
+}
+.result {
+    margin: 12px 0;
+    padding: 14px;
+    border-radius: 8px;
+    background: #e8f5e8;
+    border-left: 4px solid #4caf50;
+    font-size: 14px;
+}
+.result.error {
+    background: #ffebee;
+    border-left-color: #f44336;
+}
+.logout {
+    float: right;
+    color: #007cba;
+    text-decoration: none;
+    padding: 8px 16px;
+    border: 1px solid #007cba;
+    border-radius: 6px;
+    font-size: 14px;
+}
+.logout + .logout {
+    margin-right: 8px;
+}
+.search {
+    margin-top: 12px;
+}
+.history {
+    width: 100%;
+    border-collapse: collapse;
+    font-size: 14px;
+}
+.history th, .history td {
+    text-align: left;
+    padding: 8px 6px;
+    border-bottom: 1px solid #eee;
+    word-break: break-word;
+}
+.more {
+    display: inline-block;
+    margin-top: 15px;
+    color: #007cba;
+}
+.status {
+    margin: 12px 0;
+    padding: 12px;
+    background: #f8f9fa;
+    border-radius: 6px;
+    font-size: 14px;
+}
+.photo-section {
+    margin: 15px 0;
+    padding: 15px;
+    background: #f8f9fa;
+    border-radius: 8px;
+    border: 2px dashed #ddd;
+}
+.file-input {
+    display: none;
+}
+.file-label {
+    display: block;
+    text-align: center;
+    padding: 14px;
+    background: #007cba;
+    color: white;
+    border-radius: 8px;
+    font-size: 16px;
+    font-weight: 500;
+    cursor: pointer;
+    margin-bottom: 10px;
+}
+.preview-container {
+    text-align: center;
+    margin-top: 10px;
+}
+.image-preview {
+    max-width: 200px;
+    max-height: 200px;
+    border-radius: 6px;
+    border: 1px solid #ddd;
+    display: none;
+}
+.loading {
+    display: none;
+    text-align: center;
+    margin: 15px 0;
+}
+.spinner {
+    border: 3px solid #f3f3f3;
+    border-top: 3px solid #007cba;
+    border-radius: 50%;
+    width: 30px;
+    height: 30px;
+    animation: spin 1s linear infinite;
+    margin: 0 auto 10px;
+}
+@keyframes spin {
+    0% { transform: rotate(0deg); }
+    100% { transform: rotate(360deg); }
+}
+h1 {
+    font-size: 22px;
+    color: #1a1a1a;
+    margin-bottom: 10px;
+}
+h2 {
+    font-size: 18px;
+    color: #333;
+    margin-bottom: 15px;
+}
+"""
+
+MAIN_JS = """
+// Image preview
+document.getElementById('photo').addEventListener('change', function(e) {
+    const file = e.target.files[0];
+    const preview = document.getElementById('imagePreview');
+
+    if (file) {
+        const reader = new FileReader();
+        reader.onload = function(e) {
+            preview.src = e.target.result;
+            preview.style.display = 'block';
+        };
+        reader.readAsDataURL(file);
+    } else {
+        preview.style.display = 'none';
+    }
+});
+
+// Loading animation
+document.getElementById('messageForm').addEventListener('submit', function() {
+    // Send at is in the browser's time zone
+    document.getElementById('tzOffset').value = new Date().getTimezoneOffset();
+    document.getElementById('loading').style.display = 'block';
+    document.getElementById('sendBtn').disabled = true;
+    document.getElementById('sendBtn').textContent = 'Sending...';
+});
+"""
+
+STATIC_ASSETS = {
+    '/static/login.css': StaticAsset(LOGIN_CSS, 'text/css; charset=utf-8'),
+    '/static/main.css': StaticAsset(MAIN_CSS, 'text/css; charset=utf-8'),
+    '/static/main.js': StaticAsset(MAIN_JS, 'application/javascript; charset=utf-8'),
+}
+
+LOGIN_PAGE = PageTemplate("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
+    <title>SMTP River</title>
+    <link rel="stylesheet" href="/static/login.css">
+</head>
+<body>
+    <div class="login-box">
+        <h2>SMTP River</h2>
+        {{error}}
+        <form method="POST" action="/login">
+            <input type="text" name="username" placeholder="Username" value="admin" required>
+            <input type="password" name="password" placeholder="Password" value="admin123" required>
+            <button type="submit">Login</button>
+        </form>
+        <div class="info">Default: admin / admin123</div>
+    </div>
+</body>
+</html>
+""")
+
+MAIN_PAGE = PageTemplate("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
+    <title>SMTP River</title>
+    <link rel="stylesheet" href="/static/main.css">
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>SMTP River</h1>
+            <a href="/logout" class="logout">Logout</a>
+            <a href="/history" class="logout">History</a>
+            <div class="status">
+                <strong>Status:</strong> {{status}}
+            </div>
+            {{result}}
+        </div>
+        
+        <div class="message-form">
+            <h2>Send Message</h2>
+            <form method="POST" action="/send_message" enctype="multipart/form-data" id="messageForm">
+                <input type="text" name="sender_name" placeholder="Your Name" required>
+                <input type="email" name="recipient" placeholder="To Email" required>
+                <input type="text" name="subject" placeholder="Subject" required>
+                <textarea name="message" placeholder="Type your message here..." required></textarea>
+                <label for="sendAt" class="field-label">Send at (optional, leave empty to send now)</label>
+                <input type="datetime-local" name="send_at" id="sendAt">
+                <input type="hidden" name="tz_offset" id="tzOffset">
+                
+                <div class="photo-section">
+                    <h3 style="margin-bottom: 12px; font-size: 16px;">Add Photo (Optional)</h3>
+                    <input type="file" name="photo" id="photo" accept="image/*" class="file-input">
+                    <label for="photo" class="file-label">📷 Choose Photo</label>
+                    <div class="preview-container">
+                        <img id="imagePreview" class="image-preview" alt="Preview">
+                    </div>
+                </div>
+                
+                <div class="loading" id="loading">
+                    <div class="spinner"></div>
+                    <div>Sending...</div>
+                </div>
+                
+                <button type="submit" class="send-btn" id="sendBtn">
+                    Send Message
+                </button>
+            </form>
+        </div>
+    </div>
+
+    <script src="/static/main.js"></script>
+</body>
+</html>
+""")
+
+HISTORY_PAGE = PageTemplate("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
+    <title>SMTP River - History</title>
+    <link rel="stylesheet" href="/static/main.css">
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>Send History</h1>
+            <a href="/" class="logout">Back</a>
+            <form method="GET" action="/history" class="search">
+                <input type="text" name="recipient" placeholder="Recipient starts with..." value="{{recipient}}">
+                <input type="text" name="q" placeholder="Words in subject or message" value="{{q}}">
+                <button type="submit" class="send-btn">Search</button>
+            </form>
+        </div>
+        
+        <div class="message-form">
+            <table class="history">
+                <tr><th>Sent (UTC)</th><th>To</th><th>Subject</th><th>From</th><th>Photo</th></tr>
+                {{rows}}
+            </table>
+            {{more}}
+        </div>
+    </div>
+</body>
+</html>
+""")
+
+
+def component_metrics():
+    pool = SMTP_POOL.stats()
+    relays = RELAYS.stats()
+    samples = [
+        ('smtp_river_smtp_sessions_opened_total', 'counter', "SMTP sessions opened (connect + STARTTLS + AUTH).",
+         [({}, pool['handshakes'])]),
+        ('smtp_river_smtp_session_reuse_total', 'counter', "Sends served by an already-open SMTP session.",
+         [({}, pool['hits'])]),
+        ('smtp_river_smtp_reconnects_total', 'counter', "Sends retried on a fresh SMTP session.",
+         [({}, pool['reconnects'])]),
+        ('smtp_river_smtp_sessions_idle', 'gauge', "Open SMTP sessions waiting in the pool.",
+         [({}, pool['idle'])]),
+        ('smtp_river_delivery_queue_jobs', 'gauge', "Delivery queue rows by status.",
+         [({'status': status}, count) for status, count in DELIVERY_QUEUE.stats().items()]),
+        ('smtp_river_relay_sent_today', 'gauge', "Messages sent through each relay today.",
+         [({'relay': relay['label']}, relay['sent_today']) for relay in relays.values()]),
+        ('smtp_river_relay_healthy', 'gauge', "1 if a relay is in rotation, 0 while demoted.",
+         [({'relay': relay['label']}, int(relay['healthy'])) for relay in relays.values()]),
+        ('smtp_river_delivery_queue_due', 'gauge', "Queued jobs that are due and waiting for a worker.",
+         [({}, DELIVERY_QUEUE.due())]),
+        ('smtp_river_dedup_keys', 'gauge', "Message keys held in the in-memory dedup index.",
+         [({}, len(DEDUP))]),
+    ]
+    caches = [({'cache': name}, cache.stats())
+              for name, cache in (('image_part', IMAGE_PART_CACHE), ('image', IMAGE_PROCESSOR.cache),
+                                  ('domain', DOMAIN_CHECKER.cache))]
+    samples.append(('smtp_river_cache_hits_total', 'counter', "Cache hits.",
+                    [(labels, stats['hits']) for labels, stats in caches]))
+    samples.append(('smtp_river_cache_misses_total', 'counter', "Cache misses.",
+                    [(labels, stats['misses']) for labels, stats in caches]))
+    samples.append(('smtp_river_cache_bytes', 'gauge', "Bytes held by a cache.",
+                    [(labels, stats['bytes']) for labels, stats in caches]))
+    return samples
+
+
+METRICS.add_collector(component_metrics)
+
+
+def route_label(path):
+    """Collapse a request path to a bounded set of labels for metrics."""
+    path = path.split('?', 1)[0]
+    if path.startswith('/static/'):
+        return '/static'
+    if path.startswith('/jobs/'):
+        return '/jobs/:id'
+    if path.startswith('/api/v1/messages/'):
+        return '/api/v1/messages/:id'
+    if path in ('/api/v1/messages', '/api/v1/sessions'):
+        return path
+    if path in ('/', '/login', '/logout', '/history', '/stats', '/metrics', '/send_message', '/send_batch'):
+        return path
+    return 'other'
+
+
+def instrumented(method):
+    """Count and time a do_* handler, and open a trace for the timing log."""
+    def wrapper(self):
+        self.response_status = None
+        METRICS.inc('smtp_river_http_in_flight')
+        METRICS.trace_begin()
+        start = time.perf_counter()
+        try:
+            method(self)
+        finally:
+            elapsed = time.perf_counter() - start
+            METRICS.inc('smtp_river_http_in_flight', -1)
+            route = route_label(self.path)
+            METRICS.inc('smtp_river_http_requests_total', method=self.command, route=route,
+                        status=self.response_status or 0)
+            METRICS.observe('smtp_river_http_request_seconds', elapsed, route=route)
+            METRICS.trace_end(f'{self.command} {route} {self.response_status}', elapsed)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
 
 class SMTPRiverHandler(BaseHTTPRequestHandler):
+    # Headers and body go out in separate writes; without this, keep-alive
+    # responses stall on Nagle + delayed ACK
+    disable_nagle_algorithm = True
+    # Seconds a persistent connection may wait for its next request while holding a worker
+    keep_alive_timeout = 5
     
-    def _set_headers(self, content_type='text/html; charset=utf-8'):
+    def _set_headers(self, content_type='text/html; charset=utf-8', content_length=None):
         self.send_response(200)
         self.send_header('Content-type', content_type)
+        if content_length is not None:
+            self.send_header('Content-Length', str(content_length))
+        for name, value in self.pending_headers:
+            self.send_header(name, value)
+        self.pending_headers = []
+        self.end_headers()
+    
+    def send_json(self, data, status=200):
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in self.pending_headers:
+            self.send_header(name, value)
+        self.pending_headers = []
         self.end_headers()
+        self.wfile.write(body)
     
     def handle_one_request(self):
+        self.pending_headers = []
+        self.username = None
         try:
             super().handle_one_request()
         except (BrokenPipeError, ConnectionResetError):
             pass
+        if not self.close_connection and isinstance(self.server, PooledHTTPServer):
+            # Idle until the next request; a draining server closes the connection instead
+            self.close_connection = not self.server.connection_idle(self.connection)
+        if not self.close_connection:
+            self.connection.settimeout(self.keep_alive_timeout)
+    
+    def parse_request(self):
+        self.connection.settimeout(self.timeout)
+        if isinstance(self.server, PooledHTTPServer):
+            self.server.connection_busy(self.connection)
+        return super().parse_request()
+    
+    def log_error(self, format, *args):
+        # An idle persistent connection timing out is routine
+        if format.startswith('Request timed out') and self.connection.gettimeout() == self.keep_alive_timeout:
+            return
+        super().log_error(format, *args)
+    
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+        if isinstance(self.server, PooledHTTPServer) and self.server.draining:
+            self.send_header('Connection', 'close')
+    
+    def handle_expect_100(self):
+        # Refuse oversized uploads before the client starts sending the body
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = 0
+        limit = self.body_limit()
+        if content_length > limit:
+            self.send_error(413, f"Request body exceeds {limit} bytes")
+            return False
+        return super().handle_expect_100()
+
+    def body_limit(self):
+        content_type = self.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        if self.path.partition('?')[0] == '/api/v1/messages' and content_type == 'application/json':
+            return MAX_JSON_SIZE
+        return MAX_REQUEST_SIZE
     
+    @instrumented
     def do_GET(self):
         try:
             if self.path == '/':
@@ -37,22 +2956,68 @@ class SMTPRiverHandler(BaseHTTPRequestHandler):
                 self.send_main_page()
             elif self.path == '/login':
                 self.send_login_page()
+            elif self.path.startswith('/static/'):
+                self.send_static()
+            elif self.path == '/history' or self.path.startswith('/history?'):
+                if not self.check_auth():
+                    self.send_login_page()
+                    return
+                self.send_history_page()
+            elif self.path == '/stats':
+                if not self.check_auth():
+                    self.send_login_page()
+                    return
+                self.send_json({
+                    'smtp_pool': SMTP_POOL.stats(),
+                    'relays': RELAYS.stats(),
+                    'delivery_queue': DELIVERY_QUEUE.stats(),
+                    'image_part_cache': IMAGE_PART_CACHE.stats(),
+                    'image_cache': IMAGE_PROCESSOR.cache.stats(),
+                })
+            elif self.path == '/metrics':
+                body = METRICS.render().encode('utf-8')
+                self._set_headers('text/plain; version=0.0.4; charset=utf-8', len(body))
+                self.wfile.write(body)
+            elif self.path.startswith('/api/'):
+                if not self.check_auth():
+                    self.send_api_unauthorized()
+                    return
+                job_id = self.path[len('/api/v1/messages/'):] if self.path.startswith('/api/v1/messages/') else ''
+                job = DELIVERY_QUEUE.status(int(job_id), self.username) if job_id.isdigit() else None
+                if job is None:
+                    self.send_json({'error': "Not found"}, 404)
+                    return
+                self.send_json(job)
+            elif self.path.startswith('/jobs/'):
+                if not self.check_auth():
+                    self.send_login_page()
+                    return
+                job_id = self.path[len('/jobs/'):]
+                job = DELIVERY_QUEUE.status(int(job_id), self.username) if job_id.isdigit() else None
+                if job is None:
+                    self.send_error(404, "Job not found")
+                    return
+                self.send_json(job)
             elif self.path == '/logout':
-                # Clear auth and redirect to login page
-                self.send_response(302)
-                self.send_header('Location', '/login')
-                self.send_header('Set-Cookie', 'authenticated=false; expires=Thu, 01 Jan 1970 00:00:00 GMT')
-                self.end_headers()
+                # Revoke the session and redirect to login page
+                self.clear_auth()
                 return
             else:
                 self.send_error(404, "File not found")
         except (BrokenPipeError, ConnectionResetError):
             pass
 
+    @instrumented
     def do_POST(self):
         try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            limit = self.body_limit()
+            if content_length > limit:
+                raise RequestTooLarge(f"Request body exceeds {limit} bytes")
+            
             if self.path == '/login':
-                content_length = int(self.headers.get('Content-Length', 0))
+                if content_length > MAX_FIELD_SIZE:
+                    raise RequestTooLarge(f"Login form exceeds {MAX_FIELD_SIZE} bytes")
                 post_data = self.rfile.read(content_length)
                 post_data = urlparse.parse_qs(post_data.decode('utf-8'))
                 
@@ -67,523 +3032,725 @@ class SMTPRiverHandler(BaseHTTPRequestHandler):
                     
             elif self.path == '/send_message':
                 if not self.check_auth():
+                    self.close_connection = True
                     self.send_login_page()
                     return
-                    
-                content_length = int(self.headers.get('Content-Length', 0))
-                post_data = self.rfile.read(content_length)
                 
                 # Parse multipart form data for images
                 content_type = self.headers.get('Content-Type', '')
                 if 'multipart/form-data' in content_type:
-                    result = self.handle_multipart_form(post_data, content_type)
+                    result = self.handle_multipart_form(content_type, content_length)
                 else:
+                    if content_length > MAX_FIELD_SIZE * 4:
+                        raise RequestTooLarge(f"Form exceeds {MAX_FIELD_SIZE * 4} bytes")
+                    post_data = self.rfile.read(content_length)
                     post_data = urlparse.parse_qs(post_data.decode('utf-8'))
                     result = self.send_email_simple(post_data)
                 
                 self.send_main_page(result=result)
+            elif self.path == '/send_batch':
+                if not self.check_auth():
+                    self.close_connection = True
+                    self.send_error(401, "Login required")
+                    return
+                content_type = self.headers.get('Content-Type', '')
+                if 'multipart/form-data' not in content_type:
+                    self.close_connection = True
+                    self.send_json({'error': "Upload the batch as multipart/form-data"}, 400)
+                    return
+                self.handle_batch(content_type, content_length)
+            elif self.path.startswith('/api/'):
+                self.handle_api(content_length)
+            else:
+                self.send_error(404, "File not found")
                 
         except (BrokenPipeError, ConnectionResetError):
             pass
+        except RequestTooLarge as e:
+            # The rest of the body is never read, so the connection can't be reused
+            self.close_connection = True
+            self.send_error(413, str(e))
         except Exception as e:
+            self.close_connection = True
             self.send_main_page(result=f"Error: {str(e)}")
     
-    def handle_multipart_form(self, post_data, content_type):
+    def handle_api(self, content_length):
         try:
-            boundary = content_type.split('boundary=')[1].encode()
-            parts = post_data.split(b'--' + boundary)
-            
-            form_data = {}
-            image_data = None
-            image_filename = None
-            
-            for part in parts:
-                if b'name="' in part:
-                    headers, body = part.split(b'\r\n\r\n', 1)
-                    headers = headers.decode('utf-8')
-                    
-                    if 'name="' in headers:
-                        field_name = headers.split('name="')[1].split('"')[0]
-                        
-                        if 'filename="' in headers:
-                            # File upload
-                            image_filename = headers.split('filename="')[1].split('"')[0]
-                            image_data = body[:-2]
-                        else:
-                            # Form field
-                            form_data[field_name] = body[:-2].decode('utf-8')
-            
+            path, _, query = self.path.partition('?')
+            if path == '/api/v1/sessions':
+                self.api_create_session(content_length)
+            elif path == '/api/v1/messages':
+                self.api_create_message(query, content_length)
+            else:
+                self.close_connection = True
+                self.send_json({'error': "Not found"}, 404)
+        except RequestTooLarge as e:
+            self.close_connection = True
+            self.send_json({'error': str(e)}, 413)
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except ValueError as e:
+            # Malformed JSON or base64; the body has been read, so the connection stays usable
+            self.send_json({'error': f"Bad request: {e}"}, 400)
+        except Exception as e:
+            self.close_connection = True
+            self.send_json({'error': str(e)}, 500)
+    
+    def read_json(self, content_length, limit):
+        if content_length > limit:
+            raise RequestTooLarge(f"JSON body exceeds {limit} bytes")
+        data = json.loads(self.rfile.read(content_length) or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object")
+        return data
+    
+    def read_upload(self, filename, content_type, content_length):
+        if content_length > MAX_UPLOAD_SIZE:
+            raise RequestTooLarge(f"Attachment exceeds {MAX_UPLOAD_SIZE} bytes")
+        upload = UploadedFile(filename, content_type)
+        remaining = content_length
+        while remaining:
+            chunk = self.rfile.read(min(MULTIPART_CHUNK_SIZE, remaining))
+            if not chunk:
+                upload.close()
+                raise ConnectionResetError("Request body ended early")
+            upload.write(chunk)
+            remaining -= len(chunk)
+        return upload
+    
+    def send_api_unauthorized(self):
+        self.close_connection = True
+        self.pending_headers.append(('WWW-Authenticate', 'Bearer'))
+        self.send_json({'error': "Authentication required"}, 401)
+    
+    def api_create_session(self, content_length):
+        credentials = self.read_json(content_length, MAX_FIELD_SIZE)
+        username = str(credentials.get('username', ''))
+        if not self.authenticate(username, str(credentials.get('password', ''))):
+            self.send_json({'error': "Invalid login"}, 401)
+            return
+        self.send_json({'token': SESSIONS.create(username), 'expires_in': SESSIONS.ttl}, 201)
+    
+    def api_create_message(self, query, content_length):
+        """Queue a message from a JSON body, or from a raw attachment body with the
+        fields in the query string."""
+        if not self.check_auth():
+            self.send_api_unauthorized()
+            return
+        content_type = self.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        image_data = image_filename = None
+        if content_type == 'application/json':
+            fields = self.read_json(content_length, MAX_JSON_SIZE)
+            attachment = fields.get('attachment')
+            if attachment:
+                if not isinstance(attachment, dict):
+                    raise ValueError("attachment must be an object with content and filename")
+                content, image_filename = attachment.get('content', ''), attachment.get('filename') or 'attachment'
+                if not isinstance(content, str) or not isinstance(image_filename, str):
+                    raise ValueError("attachment content and filename must be strings")
+                image_data = base64.b64decode(content, validate=True)
+                if len(image_data) > MAX_UPLOAD_SIZE:
+                    raise ValueError(f"attachment exceeds {MAX_UPLOAD_SIZE} bytes")
+        else:
+            fields = {name: values[0] for name, values in urlparse.parse_qs(query).items()}
+            if content_length:
+                image_filename = fields.get('filename') or 'attachment'
+                image_data = self.read_upload(image_filename, content_type, content_length)
+        try:
+            recipient = fields.get('recipient')
+            if not isinstance(recipient, str) or not recipient:
+                self.send_json({'error': "recipient is required"}, 400)
+                return
+            config = self.load_config()
+            if not relay_configs(config):
+                self.send_json({'error': "Configure email in smtp_config.json"}, 503)
+                return
+            try:
+                recipient = validate_recipient(recipient, config)
+            except InvalidRecipient as e:
+                self.send_json({'error': str(e)}, 422)
+                return
+            try:
+                send_at = send_time(fields.get('send_at'), fields.get('delay'))
+            except ValueError as e:
+                self.send_json({'error': str(e)}, 400)
+                return
+            idempotency_key = self.headers.get('Idempotency-Key') or fields.get('idempotency_key')
+            job_id, duplicate = self.queue_message(config, recipient, str(fields.get('subject', '')),
+                                                   str(fields.get('message', '')), str(fields.get('sender_name', '')),
+                                                   image_data, image_filename, str(idempotency_key or ''), send_at)
+        finally:
+            if isinstance(image_data, UploadedFile):
+                image_data.close()
+        self.pending_headers.append(('Location', f'/api/v1/messages/{job_id}'))
+        if duplicate:
+            self.send_json({'id': job_id, 'duplicate': True}, 200)
+        elif send_at is not None:
+            self.send_json({'id': job_id, 'status': 'scheduled', 'send_at': send_at}, 202)
+        else:
+            self.send_json({'id': job_id, 'status': 'queued'}, 202)
+    
+    def queue_message(self, config, recipient, subject, message, sender_name, image_data, image_filename,
+                      idempotency_key=None, send_at=None):
+        """Queue (or schedule) a message unless the same one was queued within the dedup window.
+        Returns (job_id, duplicate)."""
+        window = config.get('dedup_window', DEDUP_WINDOW)
+        if not window:
+            job_id = DELIVERY_QUEUE.enqueue(recipient, subject, message, sender_name, image_data, image_filename,
+                                            self.username, send_at=send_at)
+            return job_id, False
+        with METRICS.stage('dedup'):
+            key = message_key(recipient, subject, message, sender_name, image_data, idempotency_key, self.username,
+                              send_at)
+        return DEDUP.submit(key, window, lambda key: DELIVERY_QUEUE.enqueue(
+            recipient, subject, message, sender_name, image_data, image_filename, self.username, key, window,
+            send_at))
+    
+    def handle_multipart_form(self, content_type, content_length):
+        with METRICS.stage('multipart_parse'):
+            fields, files = MultipartParser(self.rfile, multipart_boundary(content_type), content_length).parse()
+        try:
+            # Any file part is the photo; browsers send an empty one when none is chosen
+            upload = next((f for f in files.values() if f.filename and f.size), None)
             return self.send_email_with_image(
-                form_data.get('recipient', ''),
-                form_data.get('subject', ''),
-                form_data.get('message', ''),
-                form_data.get('sender_name', ''),
-                image_data,
-                image_filename
+                fields.get('recipient', ''),
+                fields.get('subject', ''),
+                fields.get('message', ''),
+                fields.get('sender_name', ''),
+                upload,
+                upload.filename if upload else None,
+                fields.get('idempotency_key'),
+                fields.get('send_at'),
+                fields.get('tz_offset')
             )
-            
+        finally:
+            for upload in files.values():
+                upload.close()
+    
+    def handle_batch(self, content_type, content_length):
+        with METRICS.stage('multipart_parse'):
+            fields, files = MultipartParser(self.rfile, multipart_boundary(content_type), content_length).parse()
+        try:
+            config = self.load_config()
+            if not relay_configs(config):
+                self.send_json({'error': "Configure email in smtp_config.json"}, 503)
+                return
+            recipients = files.get('recipients')
+            if recipients is None:
+                self.send_json({'error': "A recipients file (CSV or JSONL) is required"}, 400)
+                return
+            photo = files.get('photo')
+            image_part = None
+            if photo is not None and photo.filename and photo.size:
+                image_part = build_image_part(photo, photo.filename, config)
+            batch = BatchSend(config, fields.get('sender_name', ''), fields.get('subject', ''),
+                              fields.get('message', ''), image_part, username=self.username)
+            recipients.file.seek(0)
+            self.stream_ndjson(batch.run(read_recipients(recipients.file, recipients.filename)))
+        finally:
+            for upload in files.values():
+                upload.close()
+    
+    def stream_ndjson(self, items):
+        # Chunked when the connection is persistent, otherwise delimited by close
+        chunked = self.protocol_version >= 'HTTP/1.1' and self.request_version >= 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        try:
+            for item in items:
+                self._write_stream(json.dumps(item).encode('utf-8') + b'\n', chunked)
+        except (BrokenPipeError, ConnectionResetError):
+            raise
         except Exception as e:
-            return f"Error: {str(e)}"
+            self._write_stream(json.dumps({'error': str(e)}).encode('utf-8') + b'\n', chunked)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+    
+    def _write_stream(self, data, chunked):
+        if chunked:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        self.wfile.write(data)
     
     def send_email_simple(self, post_data):
         recipient = post_data.get('recipient', [''])[0]
         subject = post_data.get('subject', [''])[0]
         message = post_data.get('message', [''])[0]
         sender_name = post_data.get('sender_name', [''])[0]
-        return self.send_email_with_image(recipient, subject, message, sender_name, None, None)
+        idempotency_key = post_data.get('idempotency_key', [''])[0]
+        send_at = post_data.get('send_at', [''])[0]
+        tz_offset = post_data.get('tz_offset', [''])[0]
+        return self.send_email_with_image(recipient, subject, message, sender_name, None, None, idempotency_key,
+                                          send_at, tz_offset)
     
-    def send_email_with_image(self, recipient, subject, message, sender_name, image_data, image_filename):
+    def send_email_with_image(self, recipient, subject, message, sender_name, image_data, image_filename,
+                              idempotency_key=None, send_at=None, tz_offset=None):
         try:
             config = self.load_config()
             
-            if not config.get('your_email') or not config.get('app_password'):
+            if not relay_configs(config):
                 return "Configure email in smtp_config.json"
             
-            msg = MIMEMultipart()
-            msg['From'] = f'{sender_name} <{config["your_email"]}>'
-            msg['To'] = recipient
-            msg['Subject'] = subject
-            
-            # Create HTML message with image AT THE TOP
-            html_message = f"""
-            <html>
-                <body>
-                    <div style="font-family: Arial, sans-serif; max-width: 100%;">
-                        <div style="background: #f8f9fa; padding: 15px; border-radius: 8px;">
-                            <h2 style="color: #333; margin: 0 0 15px 0;">{subject}</h2>
-            """
-            
-            # IMAGE AT THE TOP - before the message
-            if image_data and image_filename:
-                # Save and attach image
-                image_path = os.path.join(UPLOAD_FOLDER, image_filename)
-                with open(image_path, 'wb') as f:
-                    f.write(image_data)
-                
-                with open(image_path, 'rb') as f:
-                    img = MIMEImage(f.read())
-                    img.add_header('Content-ID', '<image1>')
-                    img.add_header('Content-Disposition', 'inline', filename=image_filename)
-                    msg.attach(img)
-                
-                html_message += f"""
-                            <div style="margin-bottom: 15px; text-align: center;">
-                                <img src="cid:image1" style="max-width: 100%; max-height: 400px; border-radius: 6px; border: 1px solid #ddd;">
-                            </div>
-                """
-                
-                os.remove(image_path)
-            
-            # MESSAGE BELOW THE IMAGE
-            html_message += f"""
-                            <div style="white-space: pre-line; line-height: 1.5; color: #555; padding: 10px 0;">
-                                {message}
-                            </div>
-                        </div>
-                    </div>
-                </body>
-            </html>
-            """
-            
-            # ONLY attach HTML version to avoid duplicates
-            msg.attach(MIMEText(html_message, 'html'))
+            recipient = validate_recipient(recipient, config)
+            send_at = send_time(send_at, tz_offset=tz_offset)
+            job_id, duplicate = self.queue_message(config, recipient, subject, message, sender_name,
+                                                   image_data, image_filename, idempotency_key, send_at)
             
-            server = smtplib.SMTP(config['smtp_server'], config['smtp_port'])
-            server.starttls()
-            server.login(config['your_email'], config['app_password'])
-            text = msg.as_string()
-            server.sendmail(config['your_email'], recipient, text)
-            server.quit()
-            
-            if image_data:
-                return f"Sent with image to {recipient}"
+            if duplicate:
+                return f"Already queued to {recipient} (job #{job_id})"
+            elif send_at is not None:
+                when = time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(send_at))
+                return f"Scheduled to {recipient} for {when} (job #{job_id})"
+            elif image_data:
+                return f"Queued with image to {recipient} (job #{job_id})"
             else:
-                return f"Sent to {recipient}"
+                return f"Queued to {recipient} (job #{job_id})"
             
-        except smtplib.SMTPAuthenticationError:
-            return "Auth failed - check password"
         except Exception as e:
             return f"Error: {str(e)}"
     
+    def session_token(self):
+        authorization = self.headers.get('Authorization', '')
+        if authorization[:7].lower() == 'bearer ':
+            return authorization[7:].strip()
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return value
+        return None
+    
     def check_auth(self):
-        cookie = self.headers.get('Cookie', '')
-        return 'authenticated=true' in cookie
+        token = self.session_token()
+        self.username = SESSIONS.verify(token) if token else None
+        return self.username is not None
     
     def set_auth(self, username):
-        self.send_response(200)
-        self.send_header('Set-Cookie', f'authenticated=true; username={username}')
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
+        # Sent with the next page instead of as a separate, premature response
+        self.pending_headers.append(('Set-Cookie', f'{SESSION_COOKIE}={SESSIONS.create(username)}; Path=/; '
+                                                   f'Max-Age={SESSIONS.ttl}; HttpOnly; SameSite=Lax'))
     
     def clear_auth(self):
+        token = self.session_token()
+        if token:
+            SESSIONS.revoke(token)
         self.send_response(302)
         self.send_header('Location', '/login')
-        self.send_header('Set-Cookie', 'authenticated=false; expires=Thu, 01 Jan 1970 00:00:00 GMT')
+        self.send_header('Set-Cookie', f'{SESSION_COOKIE}=; Path=/; Max-Age=0; HttpOnly; SameSite=Lax')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def authenticate(self, username, password):
-        users = self.load_users()
-        return username in users and users[username]['password'] == password
+        user = self.load_users().get(username)
+        if user is None:
+            # Same cost as a wrong password, so usernames can't be probed by timing
+            verify_password(UNKNOWN_USER_HASH, password)
+            return False
+        return verify_password(user.get('password_hash', ''), password)
     
     def load_config(self):
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
-        return {"smtp_server": "smtp.gmail.com", "smtp_port": 587, "your_email": "", "app_password": ""}
+        return load_config()
     
     def load_users(self):
-        if os.path.exists(USER_FILE):
-            with open(USER_FILE, 'r') as f:
-                return json.load(f)
-        return {"admin": {"password": "admin123", "email": "admin@localhost"}}
+        return load_users()
     
-    def send_login_page(self, error=None):
-        self._set_headers()
-        
-        html = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-            <title>SMTP River</title>
-            <style>
-                * { box-sizing: border-box; margin: 0; padding: 0; }
-                body { 
-                    font-family: -apple-system, BlinkMacSystemFont, sans-serif;
-                    background: #f0f2f5;
-                    padding: 20px;
-                    min-height: 100vh;
-                    display: flex;
-                    align-items: center;
-                    justify-content: center;
-                }
-                .login-box {
-                    background: white;
-                    padding: 30px 25px;
-                    border-radius: 12px;
-                    box-shadow: 0 4px 12px rgba(0,0,0,0.1);
-                    width: 100%;
-                    max-width: 400px;
-                }
-                h2 {
-                    text-align: center;
-                    color: #1a1a1a;
-                    margin-bottom: 25px;
-                    font-size: 24px;
-                }
-                input {
-                    width: 100%;
-                    padding: 14px;
-                    margin: 8px 0;
-                    border: 1px solid #ddd;
-                    border-radius: 8px;
-                    font-size: 16px;
-                    background: #fafafa;
-                }
-                button {
-                    width: 100%;
-                    background: #007cba;
-                    color: white;
-                    padding: 16px;
-                    border: none;
-                    border-radius: 8px;
-                    font-size: 17px;
-                    font-weight: 600;
-                    margin-top: 10px;
-                    cursor: pointer;
-                }
-                .error {
-                    color: #d32f2f;
-                    background: #ffebee;
-                    padding: 12px;
-                    border-radius: 6px;
-                    margin-bottom: 15px;
-                    text-align: center;
-                    font-size: 14px;
-                }
-                .info {
-                    text-align: center;
-                    margin-top: 20px;
-                    color: #666;
-                    font-size: 14px;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="login-box">
-                <h2>SMTP River</h2>
-        """
-        
-        if error:
-            html += f'<div class="error">{error}</div>'
-            
-        html += """
-                <form method="POST" action="/login">
-                    <input type="text" name="username" placeholder="Username" value="admin" required>
-                    <input type="password" name="password" placeholder="Password" value="admin123" required>
-                    <button type="submit">Login</button>
-                </form>
-                <div class="info">Default: admin / admin123</div>
-            </div>
-        </body>
-        </html>
-        """
-        
+    def send_page(self, body):
+        # Pages carry per-user status and results, so they are never cached
+        self.pending_headers.append(('Cache-Control', 'no-store'))
+        self._set_headers(content_length=len(body))
         try:
-            self.wfile.write(html.encode('utf-8'))
+            self.wfile.write(body)
         except (BrokenPipeError, ConnectionResetError):
             pass
     
-    def send_main_page(self, result=None):
-        self._set_headers()
+    def send_static(self):
+        asset = STATIC_ASSETS.get(self.path.split('?', 1)[0])
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        if self.headers.get('If-None-Match') == asset.etag:
+            self.send_response(304)
+            self.send_header('ETag', asset.etag)
+            self.send_header('Cache-Control', STATIC_CACHE_CONTROL)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(asset.body)))
+        self.send_header('ETag', asset.etag)
+        self.send_header('Cache-Control', STATIC_CACHE_CONTROL)
+        self.end_headers()
+        try:
+            self.wfile.write(asset.body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
+    def send_login_page(self, error=None):
+        self.send_page(LOGIN_PAGE.render(
+            error=f'<div class="error">{escape(error)}</div>' if error else ''))
+    
+    def send_history_page(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        recipient = query.get('recipient', [''])[0].strip()
+        text = query.get('q', [''])[0].strip()
+        before = query.get('before', [''])[0]
+        rows, cursor = HISTORY.page(recipient, text, int(before) if before.isdigit() else None)
         
-        config = self.load_config()
-        email_status = "Ready" if config.get('your_email') and config.get('app_password') else "Not configured"
+        row_html = ''.join(
+            f'<tr><td>{escape(str(row["sent_date"]))}</td><td>{escape(row["recipient"] or "")}</td>'
+            f'<td>{escape(row["subject"] or "")}</td><td>{escape(row["sender_name"] or "")}</td>'
+            f'<td>{"Yes" if row["has_image"] else ""}</td></tr>'
+            for row in rows) or '<tr><td colspan="5">No messages</td></tr>'
+        more = ''
+        if cursor is not None:
+            params = urlparse.urlencode({'recipient': recipient, 'q': text, 'before': cursor})
+            more = f'<a class="more" href="/history?{escape(params)}">Older messages</a>'
         
-        html = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-            <title>SMTP River</title>
-            <style>
-                * { box-sizing: border-box; margin: 0; padding: 0; }
-                body {
-                    font-family: -apple-system, BlinkMacSystemFont, sans-serif;
-                    background: #f0f2f5;
-                    padding: 15px;
-                    line-height: 1.4;
-                }
-                .container {
-                    max-width: 100%;
-                }
-                .header {
-                    background: white;
-                    padding: 20px;
-                    border-radius: 12px;
-                    margin-bottom: 15px;
-                    box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-                }
-                .message-form {
-                    background: white;
-                    padding: 20px;
-                    border-radius: 12px;
-                    box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-                    margin-bottom: 15px;
-                }
-                input, textarea {
-                    width: 100%;
-                    padding: 14px;
-                    margin: 8px 0;
-                    border: 1px solid #ddd;
-                    border-radius: 8px;
-                    font-size: 16px;
-                    background: #fafafa;
-                }
-                textarea {
-                    height: 120px;
-                    resize: vertical;
-                }
-                .send-btn {
-                    width: 100%;
-                    background: #007cba;
-                    color: white;
-                    padding: 16px;
-                    border: none;
-                    border-radius: 8px;
-                    font-size: 17px;
-                    font-weight: 600;
-                    margin-top: 10px;
-                    cursor: pointer;
-                }
-                .send-btn:disabled {
-                    background: #ccc;
-                    cursor: not-allowed;
-                }
-                .result {
-                    margin: 12px 0;
-                    padding: 14px;
-                    border-radius: 8px;
-                    background: #e8f5e8;
-                    border-left: 4px solid #4caf50;
-                    font-size: 14px;
-                }
-                .result.error {
-                    background: #ffebee;
-                    border-left-color: #f44336;
-                }
-                .logout {
-                    float: right;
-                    color: #007cba;
-                    text-decoration: none;
-                    padding: 8px 16px;
-                    border: 1px solid #007cba;
-                    border-radius: 6px;
-                    font-size: 14px;
-                }
-                .status {
-                    margin: 12px 0;
-                    padding: 12px;
-                    background: #f8f9fa;
-                    border-radius: 6px;
-                    font-size: 14px;
-                }
-                .photo-section {
-                    margin: 15px 0;
-                    padding: 15px;
-                    background: #f8f9fa;
-                    border-radius: 8px;
-                    border: 2px dashed #ddd;
-                }
-                .file-input {
-                    display: none;
-                }
-                .file-label {
-                    display: block;
-                    text-align: center;
-                    padding: 14px;
-                    background: #007cba;
-                    color: white;
-                    border-radius: 8px;
-                    font-size: 16px;
-                    font-weight: 500;
-                    cursor: pointer;
-                    margin-bottom: 10px;
-                }
-                .preview-container {
-                    text-align: center;
-                    margin-top: 10px;
-                }
-                .image-preview {
-                    max-width: 200px;
-                    max-height: 200px;
-                    border-radius: 6px;
-                    border: 1px solid #ddd;
-                    display: none;
-                }
-                .loading {
-                    display: none;
-                    text-align: center;
-                    margin: 15px 0;
-                }
-                .spinner {
-                    border: 3px solid #f3f3f3;
-                    border-top: 3px solid #007cba;
-                    border-radius: 50%;
-                    width: 30px;
-                    height: 30px;
-                    animation: spin 1s linear infinite;
-                    margin: 0 auto 10px;
-                }
-                @keyframes spin {
-                    0% { transform: rotate(0deg); }
-                    100% { transform: rotate(360deg); }
-                }
-                h1 {
-                    font-size: 22px;
-                    color: #1a1a1a;
-                    margin-bottom: 10px;
-                }
-                h2 {
-                    font-size: 18px;
-                    color: #333;
-                    margin-bottom: 15px;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>SMTP River</h1>
-                    <a href="/logout" class="logout">Logout</a>
-                    <div class="status">
-                        <strong>Status:</strong> """ + email_status + """
-                    </div>
-        """
+        self.send_page(HISTORY_PAGE.render(recipient=escape(recipient), q=escape(text), rows=row_html, more=more))
+    
+    def send_main_page(self, result=None):
+        config = self.load_config()
+        email_status = "Ready" if relay_configs(config) else "Not configured"
         
+        banner = ''
         if result:
             is_error = any(word in result.lower() for word in ['error', 'failed', 'invalid'])
-            html += f'<div class="result{" error" if is_error else ""}">{result}</div>'
-            
-        html += """
-                </div>
-                
-                <div class="message-form">
-                    <h2>Send Message</h2>
-                    <form method="POST" action="/send_message" enctype="multipart/form-data" id="messageForm">
-                        <input type="text" name="sender_name" placeholder="Your Name" required>
-                        <input type="email" name="recipient" placeholder="To Email" required>
-                        <input type="text" name="subject" placeholder="Subject" required>
-                        <textarea name="message" placeholder="Type your message here..." required></textarea>
-                        
-                        <div class="photo-section">
-                            <h3 style="margin-bottom: 12px; font-size: 16px;">Add Photo (Optional)</h3>
-                            <input type="file" name="photo" id="photo" accept="image/*" class="file-input">
-                            <label for="photo" class="file-label">📷 Choose Photo</label>
-                            <div class="preview-container">
-                                <img id="imagePreview" class="image-preview" alt="Preview">
-                            </div>
-                        </div>
-                        
-                        <div class="loading" id="loading">
-                            <div class="spinner"></div>
-                            <div>Sending...</div>
-                        </div>
-                        
-                        <button type="submit" class="send-btn" id="sendBtn">
-                            Send Message
-                        </button>
-                    </form>
-                </div>
-            </div>
-
-            <script>
-                // Image preview
-                document.getElementById('photo').addEventListener('change', function(e) {
-                    const file = e.target.files[0];
-                    const preview = document.getElementById('imagePreview');
-                    
-                    if (file) {
-                        const reader = new FileReader();
-                        reader.onload = function(e) {
-                            preview.src = e.target.result;
-                            preview.style.display = 'block';
-                        };
-                        reader.readAsDataURL(file);
-                    } else {
-                        preview.style.display = 'none';
-                    }
-                });
-                
-                // Loading animation
-                document.getElementById('messageForm').addEventListener('submit', function() {
-                    document.getElementById('loading').style.display = 'block';
-                    document.getElementById('sendBtn').disabled = true;
-                    document.getElementById('sendBtn').textContent = 'Sending...';
-                });
-            </script>
-        </body>
-        </html>
-        """
+            banner = f'<div class="result{" error" if is_error else ""}">{escape(result)}</div>'
         
+        self.send_page(MAIN_PAGE.render(status=email_status, result=banner))
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that hands each connection to a fixed-size pool of worker threads.
+
+    Open connections are tracked as busy or idle (a keep-alive connection
+    waiting for its next request). When every worker is taken, a new
+    connection gets the worker of the longest-idle one, and drain() closes
+    the idle ones straight away and waits for the rest.
+    """
+
+    def __init__(self, server_address, handler_class, workers=16, backlog=128, reuse_port=False):
+        self.request_queue_size = backlog
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self.draining = False
+        # socket -> True while idle between requests
+        self._connections = {}
+        self._connections_changed = threading.Condition()
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        if self.reuse_port:
+            # Every pre-forked worker listens on the port; the kernel spreads connections over them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        # Counted from accept, so a connection still waiting for a worker is drained too
+        with self._connections_changed:
+            self._connections[request] = False
+            if len(self._connections) > self.workers:
+                idle = next((sock for sock, is_idle in self._connections.items() if is_idle), None)
+                if idle is not None:
+                    self._connections[idle] = False
+                    self._hang_up(idle)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
         try:
-            self.wfile.write(html.encode('utf-8'))
-        except (BrokenPipeError, ConnectionResetError):
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._connections_changed:
+                self._connections.pop(request, None)
+                self._connections_changed.notify_all()
+
+    def connection_idle(self, request):
+        """Mark a keep-alive connection idle; False if it should be closed instead."""
+        with self._connections_changed:
+            if self.draining:
+                return False
+            self._connections[request] = True
+            return True
+
+    def connection_busy(self, request):
+        with self._connections_changed:
+            self._connections[request] = False
+
+    def _hang_up(self, request):
+        try:
+            request.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
 
-def run_server():
-    port = 8080
-    server = HTTPServer(('0.0.0.0', port), SMTPRiverHandler)
-    print(f"SMTP River running on http://localhost:{port}")
+    def drain(self, timeout=None):
+        """Wait up to timeout for in-flight requests, closing connections as they go
+        idle; returns how many were cut off."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._connections_changed:
+            self.draining = True
+            for request, idle in self._connections.items():
+                if idle:
+                    self._hang_up(request)
+            while self._connections:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._connections_changed.wait(remaining)
+            busy = list(self._connections)
+        for request in busy:
+            self._hang_up(request)
+        return len(busy)
+
+    def server_close(self, grace=None):
+        super().server_close()
+        cut_off = self.drain(grace)
+        if cut_off:
+            print(f"{cut_off} request(s) still running after {grace}s were cut off")
+        self.executor.shutdown(wait=True)
+
+
+SHUTDOWN_GRACE = 30              # seconds in-flight requests and deliveries get to finish
+
+
+class Lifecycle:
+    """Shuts the server down in order on SIGTERM or SIGINT.
+
+    New connections stop first; in-flight requests and deliveries then share
+    one grace period, after which history is flushed and pooled SMTP sessions
+    are closed with QUIT. Deliveries still running at the end go back on the
+    queue at the next start.
+    """
+
+    def __init__(self, server, grace=SHUTDOWN_GRACE):
+        self.server = server
+        self.grace = grace
+        self.stopping = False
+
+    def install(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        for signum in signals:
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.stopping:
+            print("Second signal, exiting without waiting")
+            os._exit(1)
+        self.stopping = True
+        print(f"\n{signal.Signals(signum).name} received, shutting down")
+        # shutdown() waits for serve_forever(), which this handler interrupted on the main thread
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def shutdown(self):
+        deadline = time.monotonic() + self.grace
+        # Jobs queued from here on are left for the next start (or another process)
+        SCHEDULER.stop()
+        DELIVERY_QUEUE.stop()
+        if isinstance(self.server, PooledHTTPServer):
+            self.server.server_close(grace=self.grace)
+        else:
+            self.server.server_close()
+        running = DELIVERY_QUEUE.join(timeout=max(deadline - time.monotonic(), 0))
+        if running:
+            print(f"{running} delivery(ies) still running; they will be retried at the next start")
+        HISTORY.stop()
+        SMTP_POOL.close_all()
+        IMAGE_PROCESSOR.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SMTP River web mailer")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--server', choices=['threaded', 'single'], default='threaded',
+                        help="threaded: bounded worker pool; single: one connection at a time")
+    parser.add_argument('--workers', type=int, default=16, help="HTTP worker threads (threaded server)")
+    parser.add_argument('--backlog', type=int, default=128, help="listen backlog")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="pre-fork this many server processes sharing the port (needs SO_REUSEPORT)")
+    parser.add_argument('--request-timeout', type=float, default=30,
+                        help="seconds a connection may sit idle or stall mid-request")
+    parser.add_argument('--keep-alive', action=argparse.BooleanOptionalAction,
+                        help="serve HTTP/1.1 persistent connections (default with the threaded server)")
+    parser.add_argument('--keep-alive-timeout', type=float, default=SMTPRiverHandler.keep_alive_timeout,
+                        help="seconds an idle persistent connection is kept open")
+    parser.add_argument('--shutdown-grace', type=float, default=SHUTDOWN_GRACE,
+                        help="seconds in-flight requests and deliveries get to finish on SIGTERM/SIGINT")
+    parser.add_argument('--timing-log', action='store_true',
+                        help="print a per-stage timing line for every request and delivery")
+    parser.add_argument('--hash-password', action='store_true',
+                        help="prompt for a password and print its password_hash for users.json")
+    batch = parser.add_argument_group('batch sending', "send one template to a recipient list instead of serving")
+    batch.add_argument('--batch', metavar='FILE', help="CSV (with header row) or JSONL recipient list")
+    batch.add_argument('--sender-name', default='')
+    batch.add_argument('--subject', default='')
+    batch.add_argument('--message', default='', help="HTML body; {{column}} is replaced per recipient")
+    batch.add_argument('--message-file', help="read the body from a file")
+    batch.add_argument('--image', help="image to attach at the top of every message")
+    return parser.parse_args(argv)
+
+
+def run_batch(args):
+    config = load_config()
+    if not relay_configs(config):
+        raise SystemExit("Configure email in smtp_config.json")
+    message = args.message
+    if args.message_file:
+        with open(args.message_file, 'r') as f:
+            message = f.read()
+    image_part = None
+    if args.image:
+        with open(args.image, 'rb') as f:
+            image_part = build_image_part(f.read(), os.path.basename(args.image), config)
+    batch = BatchSend(config, args.sender_name, args.subject, message, image_part)
+    HISTORY.start()
+    try:
+        with open(args.batch, 'rb') as f:
+            for result in batch.run(read_recipients(f, args.batch)):
+                print(json.dumps(result), flush=True)
+    finally:
+        HISTORY.stop()
+        SMTP_POOL.close_all()
+        IMAGE_PROCESSOR.shutdown()
+
+
+def print_banner(args):
+    print(f"SMTP River running on http://localhost:{args.port} ({args.server} server"
+          f"{f', {args.processes} processes' if args.processes > 1 else ''})")
     print("No duplicate messages - fixed!")
     print("Images at top of email")
     print("Press Ctrl+C to stop")
+
+
+def run_server(args=None, worker=False):
+    """Serve until SIGTERM or SIGINT. With worker=True this is one of run_prefork's
+    processes: it shares the port, and the supervisor handles Ctrl+C and requeues
+    jobs left by crashed workers."""
+    args = args or parse_args([])
+    port = args.port
+    SMTPRiverHandler.timeout = args.request_timeout
+    SMTPRiverHandler.keep_alive_timeout = args.keep_alive_timeout
+    METRICS.timing_log = args.timing_log
+    # A persistent client would hold the single server for its whole idle timeout
+    if args.keep_alive or args.keep_alive is None and args.server == 'threaded':
+        SMTPRiverHandler.protocol_version = 'HTTP/1.1'
+    if args.server == 'threaded':
+        server = PooledHTTPServer((args.host, port), SMTPRiverHandler, workers=args.workers, backlog=args.backlog,
+                                  reuse_port=worker)
+    else:
+        server = HTTPServer((args.host, port), SMTPRiverHandler, bind_and_activate=False)
+        server.request_queue_size = args.backlog
+        if worker:
+            server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.server_bind()
+        server.server_activate()
+    if worker:
+        # Limits and quotas are per process; together the workers stay within the configured ones
+        RATE_LIMITER.share = RELAYS.share = 1 / args.processes
+    HISTORY.start()
+    SESSIONS.init_db()
+    RELAYS.init_db()
+    DEDUP.load(load_config().get('dedup_window', DEDUP_WINDOW))
+    DELIVERY_QUEUE.start(recover=not worker)
+    SCHEDULER.start()
+    if not worker:
+        print_banner(args)
+    lifecycle = Lifecycle(server, args.shutdown_grace)
+    lifecycle.install((signal.SIGTERM,) if worker else (signal.SIGTERM, signal.SIGINT))
     try:
         server.serve_forever()
-    except KeyboardInterrupt:
-        print("\nServer stopped")
+    finally:
+        lifecycle.shutdown()
+        if not worker:
+            print("Server stopped")
+
+
+WORKER_RESTART_DELAY = 1.0       # seconds before restarting a worker that died right after starting
+
+
+def run_prefork(args):
+    """Fork args.processes copies of run_server, each with its own threads, and
+    restart any that exit until SIGTERM or SIGINT, which is passed on to all of them.
+
+    The workers share nothing in memory: config and users are read from their
+    files, session tokens are checked with the shared session_secret, and the
+    queue, history, dedup keys, relay send counts and logouts live in emails.db.
+    """
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("--processes needs fork() and SO_REUSEPORT")
+    # Set up the tables once, and no threads or database connections before forking
+    DELIVERY_QUEUE.init_db()
+    DELIVERY_QUEUE.requeue_claimed()
+    HISTORY.init_db()
+    SESSIONS.init_db()
+    RELAYS.init_db()
+    DEDUP.init_db()
+    # Created now so the workers don't race to create it
+    session_secret()
+    close_db()
+    workers = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # Ctrl+C reaches the whole process group; only the supervisor acts on it
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                run_server(args, worker=True)
+            except BaseException as e:
+                print(f"Worker {os.getpid()} failed: {e!r}")
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        workers[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        if not stopping:
+            print(f"\n{signal.Signals(signum).name} received, stopping {len(workers)} workers")
+        # A second signal makes the workers exit without waiting
+        stopping.append(signum)
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.processes):
+        spawn()
+    print_banner(args)
+    while workers:
+        pid, status = os.wait()
+        started = workers.pop(pid, None)
+        if started is None:
+            continue
+        requeued = DELIVERY_QUEUE.requeue_claimed(pid)
+        close_db()
+        if stopping:
+            continue
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting"
+              f"{f'; {requeued} job(s) it was sending requeued' if requeued else ''}")
+        if time.monotonic() - started < WORKER_RESTART_DELAY:
+            time.sleep(WORKER_RESTART_DELAY)
+        if not stopping:
+            spawn()
+    print("Server stopped")
 
 if __name__ == '__main__':
-    run_server()
+    args = parse_args()
+    if args.hash_password:
+        print(hash_password(getpass.getpass("Password: ")))
+    elif args.batch:
+        run_batch(args)
+    elif args.processes > 1:
+        run_prefork(args)
+    else:
+        run_server(args)